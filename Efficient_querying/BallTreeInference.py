@@ -0,0 +1,292 @@
+"""
+Created on Sun Oct 18 2026
+Last update: -
+
+Maximum inner product search with a ball tree: every node stores the centre
+and the radius of a ball containing its items, so that no item of the node
+can have a score higher than q . centre + ||q|| radius. The query walks the
+tree depth-first, most promising child first, and skips the nodes whose
+bound does not exceed the K-th best score found. Unlike the threshold walks,
+the bound does not get weaker for queries with many elements of mixed sign.
+The subtrees are built in parallel by a pool of processes.
+"""
+
+import numpy as np
+from multiprocessing import Pool, cpu_count
+from time import time
+from EfficientInference import TopKInference, merge_top_K
+
+# items of the trees being built, inherited by the forked worker processes
+_build_data = {}
+
+def split_items(Y, items):
+    """
+    Splits the items in two halves by their projection on the direction
+    between two items that are far apart
+    """
+    points = Y[items]
+    a = points[np.argmax(((points - points[0])**2).sum(1))]
+    b = points[np.argmax(((points - a)**2).sum(1))]
+    order = np.argsort(points.dot(a - b), kind='mergesort')
+    half = len(items) // 2
+    return items[order[:half]], items[order[half:]]
+
+def _ball(Y, items):
+    centre = Y[items].mean(0)
+    radius = np.sqrt(((Y[items] - centre)**2).sum(1).max())
+    return centre, radius
+
+def build_tree(Y, items, leaf_size=64):
+    """
+    Builds a ball tree over the items, returns a dictionary of arrays with
+    for every node its centre, radius, children (-1 for a leaf) and range
+    start:end in 'items', the items in the order of the leaves
+    """
+    centres, radii, left, right, start, end = [], [], [], [], [], []
+    leaf_items = []
+    n_leaf_items = [0]
+    def add_node(items):
+        node = len(centres)
+        centre, radius = _ball(Y, items)
+        centres.append(centre)
+        radii.append(radius)
+        left.append(-1)
+        right.append(-1)
+        start.append(n_leaf_items[0])
+        end.append(None)  # known when the subtree is done
+        if len(items) <= leaf_size:
+            leaf_items.append(items)
+            n_leaf_items[0] += len(items)
+        else:
+            left_items, right_items = split_items(Y, items)
+            left[node] = add_node(left_items)
+            right[node] = add_node(right_items)
+        end[node] = n_leaf_items[0]
+        return node
+    add_node(items)
+    return {'centres' : np.array(centres),
+            'radii' : np.array(radii),
+            'left' : np.array(left),
+            'right' : np.array(right),
+            'start' : np.array(start),
+            'end' : np.array(end),
+            'items' : np.concatenate(leaf_items)}
+
+def join_trees(Y, left_tree, right_tree):
+    """
+    Returns the tree with a new root whose children are the two given trees
+    """
+    items = np.concatenate((left_tree['items'], right_tree['items']))
+    centre, radius = _ball(Y, items)
+    n_left = len(left_tree['radii'])
+    n_left_items = len(left_tree['items'])
+    def shift(children, offset):
+        return np.where(children >= 0, children + offset, -1)
+    return {'centres' : np.vstack(([centre], left_tree['centres'],
+                    right_tree['centres'])),
+            'radii' : np.concatenate(([radius], left_tree['radii'],
+                    right_tree['radii'])),
+            'left' : np.concatenate(([1], shift(left_tree['left'], 1),
+                    shift(right_tree['left'], 1 + n_left))),
+            'right' : np.concatenate(([1 + n_left], shift(left_tree['right'], 1),
+                    shift(right_tree['right'], 1 + n_left))),
+            'start' : np.concatenate(([0], left_tree['start'],
+                    right_tree['start'] + n_left_items)),
+            'end' : np.concatenate(([len(items)], left_tree['end'],
+                    right_tree['end'] + n_left_items)),
+            'items' : items}
+
+def _build_subtree((key, items, leaf_size)):
+    return build_tree(_build_data[key], items, leaf_size)
+
+def build_tree_parallel(Y, leaf_size=64, n_processes=None, items=None):
+    """
+    Builds a ball tree over the given rows of Y (by default all): the top
+    levels are split here, the subtrees below are built by n_processes
+    processes and joined again
+    """
+    if n_processes is None:
+        n_processes = cpu_count()
+    if items is None:
+        items = np.arange(Y.shape[0])
+    parts = [items]
+    while len(parts) < n_processes and \
+                min([len(part) for part in parts]) > 2 * leaf_size:
+        parts = [half for part in parts for half in split_items(Y, part)]
+    if len(parts) == 1:
+        return build_tree(Y, parts[0], leaf_size)
+    key = id(Y)
+    _build_data[key] = Y  # before the workers are forked
+    pool = Pool(n_processes)
+    try:
+        trees = pool.map(_build_subtree, [(key, part, leaf_size)
+                    for part in parts])
+    finally:
+        pool.terminate()
+        _build_data.pop(key, None)
+    while len(trees) > 1:
+        trees = [join_trees(Y, trees[i], trees[i+1])
+                    for i in range(0, len(trees), 2)]
+    return trees[0]
+
+class BallTreeInference(TopKInference):
+    """
+    Exact top-K by branch-and-bound search in a ball tree over the items
+    Supports the methods of TopKInference (which keeps using the sorted
+    lists, when initialized) and adds get_top_K_ball, also available as
+    algorithm 'ball' in get_top_K
+    Items that are added or updated are scored from the delta buffer and
+    deleted items are skipped, until the delta buffer is merged and the tree
+    is built again
+    """
+    def __init__(self, Y, initialize_lists=False, leaf_size=64,
+                n_processes=None, max_delta=1024):
+        TopKInference.__init__(self, Y, initialize_lists,
+                    max_delta=max_delta)
+        self.leaf_size = leaf_size
+        self.n_processes = n_processes
+        self.initialize_tree()
+
+    def initialize_tree(self, n_processes=None):
+        """
+        Builds the ball tree over the items that are not deleted, the items
+        are stored in the order of the leaves
+        """
+        if n_processes is None:
+            n_processes = self.n_processes
+        tree = build_tree_parallel(np.asarray(self.Y), self.leaf_size,
+                    n_processes, np.flatnonzero(~self.deleted))
+        self.centres = tree['centres']
+        self.radii = tree['radii']
+        self.left = tree['left']
+        self.right = tree['right']
+        self.start = tree['start']
+        self.end = tree['end']
+        self.tree_items = tree['items']
+        self.Y_tree = np.ascontiguousarray(self.Y[self.tree_items])
+
+    def merge_delta(self):
+        """
+        Merges the delta buffer into the sorted lists (when initialized) and
+        builds the tree again, with the new values of the updated items
+        """
+        TopKInference.merge_delta(self)
+        self.initialize_tree()
+
+    def get_top_K_ball(self, x_u, K=1, count_calculations=False):
+        """
+        Returns top-K by a depth-first search of the ball tree
+        """
+        t0 = time()
+        trace = self._start_trace('ball')
+        x_u = np.asarray(x_u, dtype=float)
+        top_values = np.ones(K) * -1e10
+        top_items = -np.ones(K, dtype=int)
+        n_items_scored = 0
+        if len(self.delta_items):
+            scores, delta = self._score_delta(x_u)
+            top_values, top_items = merge_top_K(top_values, top_items, scores,
+                        delta, K)
+            n_items_scored += len(delta)
+        stamps, epoch = self._new_visited()
+        x_norm = np.sqrt(x_u.dot(x_u))
+        lower_bound = top_values.min()
+        n_nodes = 0
+        # (bound, node), the bounds of the children are computed when their
+        # parent is visited
+        stack = [(self.centres[0].dot(x_u) + x_norm * self.radii[0], 0)]
+        while stack:
+            bound, node = stack.pop()
+            if bound <= lower_bound:
+                continue
+            n_nodes += 1
+            left, right = self.left[node], self.right[node]
+            if left < 0:
+                start, end = self.start[node], self.end[node]
+                items = self.tree_items[start:end]
+                scores = self.Y_tree[start:end].dot(x_u)
+                # deleted or updated
+                scores[(stamps[items] == epoch) | self.deleted[items]] = -1e10
+                n_items_scored += end - start
+                top_values, top_items = merge_top_K(top_values, top_items,
+                            scores, items, K)
+                lower_bound = top_values.min()
+            else:
+                children = np.array([left, right])
+                left_bound, right_bound = self.centres[children].dot(x_u) + \
+                            x_norm * self.radii[children]
+                if left_bound > right_bound:
+                    # most promising child first
+                    stack.extend(((right_bound, right), (left_bound, left)))
+                else:
+                    stack.extend(((left_bound, left), (right_bound, right)))
+            if trace is not None:
+                trace.step(n_nodes, bound, lower_bound)
+        top_list = [(val, ind) if ind >= 0 and val > -1e10 else (val, )
+                    for val, ind in zip(top_values, top_items)]
+        top_list.sort()
+        if trace is not None:
+            trace.count_score(n=n_items_scored)
+            self._finish_trace(trace, n_nodes, n_items_scored)
+        t1 = time()
+        if count_calculations:
+            return top_list, n_items_scored, t1 - t0
+        else:
+            return top_list
+
+    def _run_queries(self, queries, K, algorithm):
+        if algorithm != 'ball':
+            return TopKInference._run_queries(self, queries, K, algorithm)
+        n_scores_calc = []
+        runtimes = []
+        top_Ks = []
+        for x_u in queries:
+            top_list, n_items_scored, runtime = self.get_top_K_ball(x_u, K,
+                        count_calculations=True)
+            top_Ks.append(top_list)
+            runtimes.append(runtime)
+            n_scores_calc.append(n_items_scored)
+        return top_Ks, n_scores_calc, runtimes
+
+if __name__ == '__main__':
+
+    R = 50
+    n = 200000
+    K = 5
+
+    Y = np.random.randn(n, R)
+    queries = np.random.randn(10, R)
+
+    t0 = time()
+    inferer = BallTreeInference(Y, initialize_lists=True)
+    t1 = time()
+
+    top_Ks_ball, n_scored_ball, runtimes_ball = inferer.get_top_K(queries, K,
+                algorithm='ball', profile=True)
+    top_Ks_block, n_scored_block, runtimes_block = inferer.get_top_K(queries,
+                K, algorithm='block', profile=True)
+
+    print 'Tested for data of size %s with R of %s' %(n, R)
+    print 'Ball tree built in %s seconds' %(t1 - t0)
+    print 'Block threshold: %s calculations in %s seconds' %(
+                np.mean(n_scored_block), np.mean(runtimes_block))
+    print 'Ball tree: %s calculations in %s seconds' %(
+                np.mean(n_scored_ball), np.mean(runtimes_ball))
+    print 'Same scores:', np.allclose([[val for val, ind in top_list]
+                for top_list in top_Ks_ball], [[val for val, ind in top_list]
+                for top_list in top_Ks_block])
+
+    # more additions and updates than fit in the delta buffer, so that the
+    # tree is built again
+    inferer = BallTreeInference(Y[:20000], max_delta=500)
+    inferer.add_items(np.random.randn(800, R))
+    inferer.update_items(np.random.choice(inferer.M, 800, replace=False),
+                np.random.randn(800, R))
+    inferer.remove_items(np.random.choice(inferer.M, 100, replace=False))
+    top_Ks_ball = inferer.get_top_K(queries, K, algorithm='ball')
+    top_Ks_naive = inferer.get_top_K(queries, K, algorithm='naive')
+    print 'Same top-K after changes:', [[item[1] for item in top_list]
+                for top_list in top_Ks_ball] == [[item[1] for item in top_list]
+                for top_list in top_Ks_naive] and np.allclose([[item[0]
+                for item in top_list] for top_list in top_Ks_ball], [[item[0]
+                for item in top_list] for top_list in top_Ks_naive])
@@ -0,0 +1,103 @@
+"""
+Created on Sun Oct 18 2026
+Last update: -
+
+Thread-pool executor for top-K queries: one immutable index is shared by
+all threads, the compiled kernels of EfficientInferenceJIT release the GIL
+and every thread reuses its own scratch buffers
+"""
+
+import numpy as np
+import threading
+from multiprocessing.pool import ThreadPool
+from multiprocessing import cpu_count
+from EfficientInferenceJIT import query_kernel, algorithm_code
+from visited import VisitedStamps
+
+class QueryExecutor():
+    """
+    Answers top-K queries in parallel threads using a shared read-only index
+    """
+    def __init__(self, Y, sorted_lists=None, n_threads=None):
+        if n_threads is None:
+            n_threads = cpu_count()
+        # read-only views, the index is never changed after construction
+        self.Y = np.ascontiguousarray(Y).view()
+        self.Y.setflags(write=False)
+        if sorted_lists is None:
+            sorted_lists = (-self.Y).argsort(0)
+        self.sorted_lists = np.asarray(sorted_lists).view()
+        self.sorted_lists.setflags(write=False)
+        self.M, self.R = self.Y.shape
+        self._scratch = threading.local()
+        self.pool = ThreadPool(n_threads)
+
+    def _get_scratch(self, K):
+        """
+        Returns the scratch buffers of the calling thread, for a top-K
+        """
+        scratch = self._scratch
+        if not hasattr(scratch, 'visited'):
+            scratch.visited = VisitedStamps(self.M)
+            scratch.partial_scores = np.zeros(self.R)
+        if not hasattr(scratch, 'values') or len(scratch.values) != K:
+            scratch.values = np.empty(K)
+            scratch.indices = np.empty(K, dtype=np.int64)
+        return scratch
+
+    def query(self, x_u, K=1, algorithm='threshold'):
+        """
+        Runs a single query in the calling thread, returns the values and
+        indices of the top-K (sorted in increasing order) and the number of
+        calculations
+        """
+        scratch = self._get_scratch(K)
+        x_u = np.asarray(x_u, dtype=float)
+        n_calc = query_kernel(x_u, self.Y, self.sorted_lists, scratch.values,
+                    scratch.indices, scratch.visited.stamps,
+                    scratch.visited.new_epoch(), scratch.partial_scores,
+                    algorithm_code(algorithm))
+        order = np.argsort(scratch.values)
+        return scratch.values[order], scratch.indices[order], n_calc
+
+    def submit(self, x_u, K=1, algorithm='threshold'):
+        """
+        Runs a query in the thread pool, returns an AsyncResult
+        """
+        return self.pool.apply_async(self.query, (x_u, K, algorithm))
+
+    def get_top_K(self, queries, K=1, algorithm='threshold'):
+        """
+        Returns the (values, indices, n_calculations) of all queries, which
+        are answered in parallel
+        """
+        return self.pool.map(lambda x_u: self.query(x_u, K, algorithm),
+                    queries)
+
+    def close(self):
+        """
+        Stops the threads of the pool
+        """
+        self.pool.close()
+        self.pool.join()
+
+if __name__ == '__main__':
+
+    from time import time
+
+    R = 10
+    n = 500000
+    K = 5
+
+    Y = np.random.randn(n, R)
+    queries = np.random.randn(200, R)
+
+    for n_threads in [1, 2, 4]:
+        executor = QueryExecutor(Y, n_threads=n_threads)
+        executor.get_top_K(queries[:2], K)  # compile
+        t0 = time()
+        results = executor.get_top_K(queries, K, algorithm='threshold')
+        t1 = time()
+        executor.close()
+        print 'Threshold with %s threads: %s queries per second' %(
+                    n_threads, len(queries) / (t1 - t0))
@@ -9,10 +9,23 @@ Implementation of algorithms for the efficient inference of the top-K of
 seperable linear models
 """
 
+import numpy as np
 from numpy import dot
 from heapq import heapify, heappop, heappush, heapreplace
 from time import time
 from numba import jit
+from heaps import min_heap_update
+from postings import IMPACT_LEVELS, compress_rows, quantize_impacts, \
+            unpack_rows
+from result_cache import ResultCache
+from instrumentation import Instrumentation, MemorySink
+from visited import VisitedStamps
+import hashlib
+import json
+import os
+import threading
+
+INDEX_FORMAT_VERSION = 2  # 1: the checksum only covers Y and the lists
 
 def calculate_partial_score(r, pos, xi, Y, sorted_lists):
     """
@@ -75,28 +88,642 @@ def simple_thr(x, Y, sorted_lists, K):
         pos +=1
     return top_K, calculated
 
+def merge_top_K(top_values, top_items, scores, items, K):
+    """
+    Merges new scores of items into arrays with the K best values and items
+    (in no particular order), for one query or for a batch of queries (rows)
+    """
+    all_values = np.concatenate((top_values, scores), axis=-1)
+    all_items = np.concatenate((top_items,
+                np.broadcast_to(items, scores.shape)), axis=-1)
+    best = np.argpartition(-all_values, K - 1, axis=-1)[..., :K]
+    return (np.take_along_axis(all_values, best, axis=-1),
+                np.take_along_axis(all_items, best, axis=-1))
+
+def update_top_K(top_values, top_slots, in_top, values, changed, K):
+    """
+    Updates the K best values (top_values at the slots top_slots, -1 when
+    missing) after the values at the slots changed have increased, in_top
+    marks the slots in the top and is updated too
+    """
+    known = top_slots >= 0
+    top_values[known] = values[top_slots[known]]
+    changed = changed[~in_top[changed]]
+    if len(changed):
+        in_top[top_slots[known]] = False
+        top_values, top_slots = merge_top_K(top_values, top_slots,
+                    values[changed], changed, K)
+        in_top[top_slots[top_slots >= 0]] = True
+    return top_values, top_slots
+
+def grow_rows(array, n):
+    """
+    Returns the array, or a copy with room for at least n rows when it is
+    too small, at least doubling its capacity
+    """
+    if n <= len(array):
+        return array
+    grown = np.empty((max(n, 2 * len(array)), ) + array.shape[1:],
+                dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+def top_k_all(X, Y, K=1, exclude=None, query_block_size=1024,
+            item_block_size=4096):
+    """
+    Exact top-K of every query (row of X) over all items (rows of Y), for
+    offline scoring of all queries at once
+    X and Y are processed in tiles: the scores of a tile are a single matrix
+    product and are merged into the running top-K of its queries, so the
+    memory used does not depend on the number of items
+    exclude is an optional sparse matrix (queries x items) whose non-zero
+    elements are pairs that can not be in the top-K (e.g. known items)
+    Returns the values and the items (-1 when missing) of the top-K of every
+    query, sorted in increasing order
+    """
+    n_queries, M = X.shape[0], Y.shape[0]
+    top_values = np.ones((n_queries, K)) * -1e10
+    top_items = -np.ones((n_queries, K), dtype=int)
+    if exclude is not None:
+        exclude = exclude.tocsr()
+    for q_start in range(0, n_queries, query_block_size):
+        q_stop = min(q_start + query_block_size, n_queries)
+        X_block = X[q_start:q_stop]
+        if exclude is not None:
+            # excluded pairs of these queries, ordered by item
+            excluded = exclude[q_start:q_stop].tocoo()
+            order = np.argsort(excluded.col, kind='mergesort')
+            excluded_rows = excluded.row[order]
+            excluded_cols = excluded.col[order]
+        values = top_values[q_start:q_stop]
+        items = top_items[q_start:q_stop]
+        for i_start in range(0, M, item_block_size):
+            i_stop = min(i_start + item_block_size, M)
+            scores = X_block.dot(Y[i_start:i_stop].T)
+            if exclude is not None:
+                first, last = np.searchsorted(excluded_cols, [i_start, i_stop])
+                scores[excluded_rows[first:last],
+                            excluded_cols[first:last] - i_start] = -np.inf
+            values, items = merge_top_K(values, items, scores,
+                        np.arange(i_start, i_stop), K)
+        order = np.argsort(values, axis=1)
+        top_values[q_start:q_stop] = np.take_along_axis(values, order, axis=1)
+        top_items[q_start:q_stop] = np.take_along_axis(items, order, axis=1)
+    return top_values, top_items
+
+@jit(nopython=True, nogil=True)
+def wand_load_block(c, block, block_starts, doc_rows, packed_rows,
+            block_offsets, block_bits, block_first, compressed, blocks, buffer):
+    """
+    Decodes the rows of a block into the buffer of WAND cursor c
+    """
+    blocks[c] = block
+    start, n = block_starts[block], block_starts[block + 1] - block_starts[block]
+    if compressed:
+        unpack_rows(packed_rows, block_offsets[block], block_bits[block],
+                    block_first[block], n, buffer[c])
+    else:
+        buffer[c, :n] = doc_rows[start:start + n]
+
+@jit(nopython=True, nogil=True)
+def wand_engine(x_dense, weights, bounds, first_blocks, end_blocks,
+            block_starts, block_last, block_max, doc_rows, doc_values,
+            packed_rows, block_offsets, block_bits, block_first, impacts,
+            compressed, block_size, indptr, indices, data, values, items,
+            use_block_max):
+    """
+    Document-at-a-time WAND over the postings of the query features (the
+    cursors) in increasing order of the rows: an item is only scored when
+    the bounds of the cursors at or before it exceed the lower bound of the
+    top in the min heap (values, items). With use_block_max the maxima of
+    the current blocks of these cursors give a second, tighter bound and
+    whole blocks are skipped when it fails
+    The cursors decode one block of rows at a time, from doc_rows or, when
+    compressed, from the packed rows. Before an item is scored from Y (in
+    CSR format: indptr, indices, data), the values of its postings (from
+    doc_values, or the quantized impacts) must also exceed the lower bound
+    Returns the number of items scored and of pivots
+    """
+    M = len(indptr) - 1
+    n_cursors = len(weights)
+    buffer = np.empty((n_cursors, block_size), dtype=np.int64)
+    blocks = np.empty(n_cursors, dtype=np.int64)
+    positions = np.zeros(n_cursors, dtype=np.int64)  # in the block
+    rows = np.empty(n_cursors, dtype=np.int64)
+    for c in range(n_cursors):
+        wand_load_block(c, first_blocks[c], block_starts, doc_rows,
+                    packed_rows, block_offsets, block_bits, block_first,
+                    compressed, blocks, buffer)
+        rows[c] = buffer[c, 0]
+    order = np.arange(n_cursors)
+    lower_bound = values[0]
+    n_items_scored = 0
+    n_pivots = 0
+    while True:
+        # cursors by row, nearly sorted after the previous step
+        for i in range(1, n_cursors):
+            j = i
+            while j > 0 and rows[order[j - 1]] > rows[order[j]]:
+                order[j - 1], order[j] = order[j], order[j - 1]
+                j -= 1
+        # pivot: first cursor where the bounds add up to more than the
+        # lower bound, no item before its row can enter the top
+        upper_bound = 0.0
+        pivot = -1
+        for i in range(n_cursors):
+            if rows[order[i]] >= M:
+                break
+            upper_bound += bounds[order[i]]
+            if upper_bound > lower_bound:
+                pivot = i
+                break
+        if pivot < 0:
+            break
+        row = rows[order[pivot]]
+        while pivot + 1 < n_cursors and rows[order[pivot + 1]] == row:
+            pivot += 1
+        n_pivots += 1
+        # rows the cursors up to the pivot move to
+        next_row = row
+        skip = False
+        if use_block_max:
+            # items from row up to block_row are in the current blocks
+            block_row = M
+            if pivot + 1 < n_cursors:
+                block_row = rows[order[pivot + 1]]
+            upper_bound = 0.0
+            for i in range(pivot + 1):
+                c = order[i]
+                block = blocks[c]
+                if block_last[block] < row:
+                    block += np.searchsorted(block_last[block:end_blocks[c]],
+                                row)
+                if block < end_blocks[c]:
+                    upper_bound += weights[c] * block_max[block]
+                    block_row = min(block_row, block_last[block] + 1)
+            if upper_bound <= lower_bound:
+                next_row = block_row
+                skip = True
+        if not skip and rows[order[0]] == row:
+            # all cursors up to the pivot are on this row
+            upper_bound = 0.0
+            for i in range(pivot + 1):
+                c = order[i]
+                position = block_starts[blocks[c]] + positions[c]
+                if compressed:
+                    upper_bound += weights[c] * impacts[position] * \
+                                block_max[blocks[c]] / IMPACT_LEVELS
+                else:
+                    upper_bound += weights[c] * doc_values[position]
+            if upper_bound > lower_bound:
+                score = 0.0
+                for p in range(indptr[row], indptr[row + 1]):
+                    score += data[p] * x_dense[indices[p]]
+                if score > lower_bound:
+                    lower_bound = min_heap_update(values, items, score, row)
+                n_items_scored += 1
+            next_row = row + 1
+        for i in range(pivot + 1):
+            c = order[i]
+            if rows[c] >= next_row:
+                continue
+            # move cursor c to its first row of at least next_row
+            if block_last[blocks[c]] < next_row:
+                block = blocks[c] + 1 + np.searchsorted(
+                            block_last[blocks[c] + 1:end_blocks[c]], next_row)
+                if block == end_blocks[c]:
+                    rows[c] = M
+                    continue
+                wand_load_block(c, block, block_starts, doc_rows,
+                            packed_rows, block_offsets, block_bits,
+                            block_first, compressed, blocks, buffer)
+                positions[c] = 0
+            while buffer[c, positions[c]] < next_row:
+                positions[c] += 1
+            rows[c] = buffer[c, positions[c]]
+    return n_items_scored, n_pivots
+
+def index_checksum(Y, sorted_lists, Y_sorted=None, deleted=None):
+    """
+    SHA-1 checksum of the item matrix, the sorted lists and, when given, the
+    sorted values and the deleted items
+    """
+    checksum = hashlib.sha1()
+    for array in (Y, sorted_lists, Y_sorted, deleted):
+        if array is not None:
+            checksum.update(np.ascontiguousarray(array).data)
+    return checksum.hexdigest()
+
+def load_index(directory, verify=False):
+    """
+    Loads an index written by TopKInference.save_index, Y and the sorted lists
+    are memory-mapped read-only so that processes share the page cache
+    The settings of the index (block size, delta buffer, access costs) are
+    restored and the norm buckets of an index saved with a bucket size are
+    built again
+    When verify is True, the checksum is checked (this reads all the data)
+    """
+    with open(os.path.join(directory, 'metadata.json')) as fh:
+        metadata = json.load(fh)
+    if metadata['version'] not in (1, INDEX_FORMAT_VERSION):
+        raise ValueError('Unsupported index version %s' %metadata['version'])
+    Y = np.load(os.path.join(directory, 'Y.npy'), mmap_mode='r')
+    sorted_lists = np.load(os.path.join(directory, 'sorted_lists.npy'),
+                mmap_mode='r')
+    if list(Y.shape) != metadata['shape'] or \
+            Y.dtype.str != metadata['dtype'] or \
+            sorted_lists.shape[1] != Y.shape[1] or \
+            sorted_lists.dtype.str != metadata['sorted_lists_dtype']:
+        raise ValueError('Index files do not match the metadata')
+    Y_sorted_file = os.path.join(directory, 'Y_sorted.npy')
+    if os.path.isfile(Y_sorted_file):
+        Y_sorted = np.load(Y_sorted_file, mmap_mode='r')
+    else:
+        # written before the values were saved, gathered once
+        Y_sorted = np.take_along_axis(np.asarray(Y), sorted_lists, axis=0)
+    deleted_file = os.path.join(directory, 'deleted.npy')
+    deleted = np.load(deleted_file) if os.path.isfile(deleted_file) else None
+    if verify:
+        if metadata['version'] == 1:
+            checksum = index_checksum(Y, sorted_lists)
+        else:
+            checksum = index_checksum(Y, sorted_lists, Y_sorted, deleted)
+        if checksum != metadata['checksum']:
+            raise ValueError('Checksum of the index does not match')
+    settings = metadata.get('settings', {})
+    inferer = TopKInference(Y, block_size=settings.get('block_size', 64),
+                max_delta=settings.get('max_delta', 1024))
+    inferer.set_access_costs(settings.get('sorted_cost', 1.0),
+                settings.get('random_cost'))
+    inferer.sorted_lists = sorted_lists
+    inferer.Y_sorted = Y_sorted
+    if deleted is not None:
+        inferer.deleted = deleted  # already left out of the sorted lists
+    if metadata.get('bucket_size') is not None:
+        inferer.initialize_norm_buckets(metadata['bucket_size'])
+    return inferer
+
 class TopKInference():
     """
     A module collecting different algorithms to find the top-K for a given
     query and SEP-LR model.
     This class is designed for dense matrices
+    With bucket_size, the items are also grouped in buckets of decreasing
+    norm (see initialize_norm_buckets), for get_top_K_norm and for pruning
+    by the Cauchy-Schwarz bound in the block threshold walk
     """
-    def __init__(self, Y, initialize_lists=False):
+    # the top lists of these are not ordered by the exact scores, so the
+    # cached result for a larger K does not answer a smaller K
+    unordered_algorithms = frozenset(['nra'])
+
+    def __init__(self, Y, initialize_lists=False, block_size=64,
+                max_delta=1024, bucket_size=None):
         self.Y = Y
         self.M, self.R = Y.shape
+        self.block_size = block_size
+        # incremental changes: deleted items are tombstones, new and updated
+        # items wait in a delta buffer until it exceeds max_delta items
+        self.max_delta = max_delta
+        self.deleted = np.zeros(self.M, dtype=bool)
+        self._Y_buffer = None  # Y and deleted are views of these when grown
+        self._deleted_buffer = None
+        self.delta_items = []
+        # items the walks over the lists skip: the tombstones still in the
+        # lists and the items of the delta buffer
+        self.skip_items = set([])
+        self._skip_array = (None, None)  # (version, skip_items as array)
+        self._scratch = threading.local()  # visited stamps of every thread
+        self.version = 0  # changes with every change of the index
+        self.cache = None
+        self.instrumentation = None
+        # costs of sorted and random access for get_top_K_combined
+        self.sorted_cost = 1.0
+        self.random_cost = None
+        self.bucket_size = bucket_size
+        self.norm_order = None
         if initialize_lists:
             self.initialize_sorted_lists()
+        if bucket_size is not None:
+            self.initialize_norm_buckets(bucket_size)
 
     def initialize_sorted_lists(self):
         """
-        Initializes the sorted lists
+        Initializes the sorted lists, as int32 when possible, and the values
+        of Y in the same order, which the walks read for their bounds
+        """
+        if self.deleted.any():
+            # deleted items are left out, as after a merge
+            items = np.flatnonzero(~self.deleted)
+            self.sorted_lists = items[self.Y[items].argsort(0)]
+        else:
+            self.sorted_lists = self.Y.argsort(0)
+        if self.M < 2**31:
+            self.sorted_lists = self.sorted_lists.astype(np.int32)
+        self.Y_sorted = np.take_along_axis(np.asarray(self.Y),
+                    self.sorted_lists, axis=0)
+        self.version += 1
+
+    def initialize_norm_buckets(self, bucket_size=256):
+        """
+        Orders the items by decreasing norm and groups them in buckets of
+        bucket_size items, with for every bucket the largest norm and the
+        smallest and largest value of every feature
+        """
+        self.bucket_size = bucket_size
+        self.item_norms = np.sqrt(np.einsum('ij,ij->i', self.Y, self.Y,
+                    dtype=float))
+        self.norm_order = np.argsort(-self.item_norms, kind='mergesort')
+        if self.M < 2**31:
+            self.norm_order = self.norm_order.astype(np.int32)
+        self.bucket_ptr = np.arange(0, self.M + bucket_size, bucket_size)
+        self.bucket_ptr[-1] = self.M
+        starts = self.bucket_ptr[:-1]
+        self.bucket_norms = self.item_norms[self.norm_order[starts]]
+        Y_ordered = self.Y[self.norm_order]
+        self.bucket_max = np.maximum.reduceat(Y_ordered, starts)
+        self.bucket_min = np.minimum.reduceat(Y_ordered, starts)
+
+    def enable_cache(self, max_size=10000, ttl=None):
+        """
+        Caches the results of get_top_K, with at most max_size entries that
+        expire after ttl seconds
+        """
+        self.cache = ResultCache(max_size, ttl)
+        return self.cache
+
+    def disable_cache(self):
+        self.cache = None
+
+    def set_instrumentation(self, instrumentation):
+        """
+        Reports per-query measurements to an Instrumentation, None turns the
+        instrumentation off
+        """
+        self.instrumentation = instrumentation
+
+    def _start_trace(self, engine):
+        if self.instrumentation is None:
+            return None
+        return self.instrumentation.start(engine)
+
+    def _finish_trace(self, trace, depth, n_items_scored):
+        if trace is not None:
+            self.instrumentation.finish(trace, depth, n_items_scored)
+
+    def add_items(self, Y_new):
+        """
+        Adds the rows of Y_new as new items, returns their indices
+        Y grows by doubling its capacity, so that adding an item costs O(R)
+        amortised instead of copying Y every time
+        """
+        Y_new = np.atleast_2d(Y_new)
+        M = self.M + Y_new.shape[0]
+        new_items = range(self.M, M)
+        dtype = np.result_type(self.Y, Y_new)
+        if self._Y_buffer is None or self.Y.base is not self._Y_buffer or \
+                    M > len(self._Y_buffer) or self._Y_buffer.dtype != dtype:
+            self._Y_buffer = np.empty((max(M, 2 * self.M), self.R),
+                        dtype=dtype)
+            self._Y_buffer[:self.M] = self.Y
+        self._Y_buffer[self.M:M] = Y_new
+        self.Y = self._Y_buffer[:M]
+        if self._deleted_buffer is None or \
+                    self.deleted.base is not self._deleted_buffer or \
+                    M > len(self._deleted_buffer):
+            self._deleted_buffer = np.zeros(len(self._Y_buffer), dtype=bool)
+            self._deleted_buffer[:self.M] = self.deleted
+        self.deleted = self._deleted_buffer[:M]
+        self.M = M
+        self.delta_items.extend(new_items)
+        self.skip_items.update(new_items)
+        self.version += 1
+        self._check_delta()
+        return new_items
+
+    def remove_items(self, items):
+        """
+        Removes items, these remain in the sorted lists as tombstones until
+        the next merge
+        """
+        self.deleted[items] = True
+        self.skip_items.update(np.atleast_1d(items).tolist())
+        self.version += 1
+
+    def update_items(self, items, Y_new):
+        """
+        Replaces the rows of the given items and moves them to the delta
+        buffer, their old entries remain in the sorted lists as tombstones
+        until the next merge
+        An item given more than once gets its last row
+        """
+        items = np.atleast_1d(items)
+        Y_new = np.broadcast_to(Y_new, (len(items), self.R))
+        unique_items, last = np.unique(items[::-1], return_index=True)
+        items, Y_new = unique_items, Y_new[len(items) - 1 - last]
+        if not self.Y.flags.writeable:
+            self.Y = np.array(self.Y)  # e.g. a read-only memory map
+        self.Y[items] = Y_new
+        new_items = [item for item in items.tolist()
+                    if item not in self.skip_items]
+        self.delta_items.extend(new_items)
+        self.skip_items.update(new_items)
+        self.version += 1
+        self._check_delta()
+
+    def _check_delta(self):
+        if len(self.delta_items) > self.max_delta:
+            self.merge_delta()
+
+    def merge_delta(self):
+        """
+        Merges the delta buffer into the sorted lists, when these are
+        initialized, and purges the tombstones, deleted items are left out
+        of the lists (also of lists initialized later) but not of the norm
+        buckets
+        """
+        if hasattr(self, 'sorted_lists'):
+            self._merge_sorted_lists()
+        self.delta_items = []
+        self.skip_items = set([])
+        self.version += 1
+        if self.norm_order is not None:
+            self.initialize_norm_buckets(self.bucket_size)
+
+    def _merge_sorted_lists(self):
+        """
+        Inserts the items of the delta buffer in the sorted lists and drops
+        the tombstones (of deleted and updated items), in O(M) per list
+        instead of sorting again
+        """
+        delta = np.unique(np.array([item for item in self.delta_items
+                    if not self.deleted[item]], dtype=int))
+        # deleted items and the old entries of updated items
+        stale = self.deleted.copy()
+        stale[np.array(self.delta_items, dtype=int)] = True
+        keep = ~stale[self.sorted_lists[:, 0]]
+        merged = np.empty((keep.sum() + len(delta), self.R),
+                    dtype=self.sorted_lists.dtype)
+        merged_values = np.empty(merged.shape, dtype=self.Y_sorted.dtype)
+        for r in range(self.R):
+            column = self.sorted_lists[:, r]
+            kept = ~stale[column]
+            column = column[kept]
+            values = self.Y_sorted[kept, r]
+            delta_column = delta[np.argsort(self.Y[delta, r], kind='mergesort')]
+            positions = np.searchsorted(values, self.Y[delta_column, r])
+            merged[:, r] = np.insert(column, positions, delta_column)
+            merged_values[:, r] = np.insert(values, positions,
+                        self.Y[delta_column, r])
+        self.sorted_lists = merged
+        self.Y_sorted = merged_values
+
+    def _score_delta(self, x_u):
+        """
+        Scores the items in the delta buffer that are not deleted, returns
+        the scores and the items
+        """
+        delta = np.array([item for item in self.delta_items
+                    if not self.deleted[item]], dtype=int)
+        return self.Y[delta].dot(x_u), delta
+
+    def _initial_top_list(self, x_u, K):
+        """
+        Returns a top list (heap) containing the best items of the delta buffer
+        """
+        top_list = [(-1e10,) for i in range(K)]
+        if len(self.delta_items):
+            for score, item in zip(*self._score_delta(x_u)):
+                if top_list[0][0] < score:
+                    heapreplace(top_list, (score, item))
+        return top_list
+
+    def _new_visited(self, n_epochs=1):
+        """
+        Returns the visited stamps of the calling thread and a new epoch for
+        a walk over the sorted lists, the items to skip are already visited
+        With n_epochs, the walk may also use the epochs after the returned
+        one (e.g. to count in how many lists an item was seen)
+        """
+        scratch = self._scratch
+        if not hasattr(scratch, 'visited'):
+            scratch.visited = VisitedStamps(self.M)
+        visited = scratch.visited
+        visited.resize(self.M)
+        epoch = visited.new_epochs(n_epochs)
+        skip = self._skipped()
+        if len(skip):
+            visited.stamps[skip] = epoch
+        return visited.stamps, epoch
+
+    def _skipped(self):
+        """
+        Returns the items to skip as an array, kept until the index changes
         """
-        self.sorted_lists = self.Y.argsort(0)
+        version, skip = self._skip_array
+        if version != self.version:
+            skip = np.fromiter(self.skip_items, dtype=int,
+                        count=len(self.skip_items))
+            self._skip_array = (self.version, skip)
+        return skip
+
+    def _candidate_slots(self):
+        """
+        Returns an array of the calling thread with a slot for every item,
+        only valid for the items stamped as candidates in the current walk
+        """
+        scratch = self._scratch
+        if not hasattr(scratch, 'slots') or len(scratch.slots) < self.M:
+            scratch.slots = np.empty(max(self.M, 2 * len(getattr(scratch,
+                        'slots', []))), dtype=np.int64)
+        return scratch.slots
+
+    def save_index(self, directory):
+        """
+        Writes Y, the sorted lists (as int32 when possible, sorted first when
+        they were not initialized), the deleted items, the settings and the
+        metadata to a directory, which can be memory-mapped again with
+        load_index
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if len(self.delta_items):
+            self.merge_delta()
+        if not hasattr(self, 'sorted_lists'):
+            self.initialize_sorted_lists()
+        if self.M < 2**31:
+            sorted_lists = self.sorted_lists.astype(np.int32)
+        else:
+            sorted_lists = self.sorted_lists
+        Y = np.ascontiguousarray(self.Y)
+        Y_sorted = np.ascontiguousarray(self.Y_sorted)
+        np.save(os.path.join(directory, 'Y.npy'), Y)
+        np.save(os.path.join(directory, 'sorted_lists.npy'), sorted_lists)
+        np.save(os.path.join(directory, 'Y_sorted.npy'), Y_sorted)
+        np.save(os.path.join(directory, 'deleted.npy'), self.deleted)
+        metadata = {'version' : INDEX_FORMAT_VERSION,
+                    'shape' : [self.M, self.R],
+                    'dtype' : Y.dtype.str,
+                    'sorted_lists_dtype' : sorted_lists.dtype.str,
+                    'bucket_size' : self.bucket_size,
+                    'settings' : {'block_size' : self.block_size,
+                            'max_delta' : self.max_delta,
+                            'sorted_cost' : self.sorted_cost,
+                            'random_cost' : self.random_cost},
+                    'checksum' : index_checksum(Y, sorted_lists, Y_sorted,
+                            self.deleted)}
+        with open(os.path.join(directory, 'metadata.json'), 'w') as fh:
+            json.dump(metadata, fh, indent=2)
 
     def get_top_K(self, queries, K=1, algorithm='threshold', profile=False):
         """
         Returns the top-K objects for a given query
         """
+        if self.cache is None:
+            top_Ks, n_scores_calc, runtimes = self._run_queries(queries, K,
+                        algorithm)
+        else:
+            top_Ks, n_scores_calc, runtimes = self._run_queries_cached(queries,
+                        K, algorithm)
+        if not profile:
+            return top_Ks
+        else:
+            return top_Ks, n_scores_calc, runtimes
+
+    def _run_queries_cached(self, queries, K, algorithm):
+        """
+        Answers the queries from the cache where possible and runs the others
+        """
+        self.cache.check_version(self.version)
+        exact_K = algorithm in self.unordered_algorithms
+        top_Ks = []
+        n_scores_calc = []
+        runtimes = []
+        misses = []
+        for x_u in queries:
+            t0 = time()
+            top_list = self.cache.get(x_u, K, algorithm, exact_K)
+            if top_list is None:
+                misses.append(len(top_Ks))
+            top_Ks.append(top_list)
+            n_scores_calc.append(0)
+            runtimes.append(time() - t0)
+        if len(misses):
+            results = self._run_queries([queries[q] for q in misses], K,
+                        algorithm)
+            for q, top_list, n_items_scored, runtime in zip(misses, *results):
+                self.cache.put(queries[q], K, algorithm, top_list, exact_K)
+                top_Ks[q] = top_list
+                n_scores_calc[q] = n_items_scored
+                runtimes[q] += runtime
+        return top_Ks, n_scores_calc, runtimes
+
+    def _run_queries(self, queries, K, algorithm):
+        """
+        Returns the top lists, the number of items scored and the runtimes
+        """
+        if algorithm == 'batch':
+            return self.get_top_K_threshold_batch(queries, K,
+                        count_calculations=True)
         n_scores_calc = []
         runtimes = []
         top_Ks = []
@@ -113,6 +740,21 @@ class TopKInference():
             elif algorithm == 'partial':
                 top_list, n_items_scored, runtime = self.get_top_K_partial_threshold(\
                     x_u, K, count_calculations=True)
+            elif algorithm == 'block':
+                top_list, n_items_scored, runtime = self.get_top_K_threshold_block(\
+                    x_u, K, count_calculations=True)
+            elif algorithm == 'fagin':
+                top_list, n_items_scored, runtime = self.get_top_K_fagin(\
+                    x_u, K, count_calculations=True)
+            elif algorithm == 'nra':
+                top_list, n_items_scored, runtime = self.get_top_K_nra(\
+                    x_u, K, count_calculations=True)
+            elif algorithm == 'combined':
+                top_list, n_items_scored, runtime = self.get_top_K_combined(\
+                    x_u, K, count_calculations=True)
+            elif algorithm == 'norm':
+                top_list, n_items_scored, runtime = self.get_top_K_norm(\
+                    x_u, K, count_calculations=True)
             elif algorithm == 'profile':
                 top_list, n_items_scored, runtime = self.get_top_K_threshold_profile(\
                     x_u, K, count_calculations=True)
@@ -120,13 +762,101 @@ class TopKInference():
                 print 'Unknown algorithm selected...'
                 raise KeyError
             top_Ks.append(top_list)
-            if profile:
-                runtimes.append(runtime)
-                n_scores_calc.append(n_items_scored)
-        if not profile:
-            return top_Ks
+            runtimes.append(runtime)
+            n_scores_calc.append(n_items_scored)
+        return top_Ks, n_scores_calc, runtimes
+
+    def get_top_K_threshold_batch(self, queries, K=1, count_calculations=False):
+        """
+        Returns the top-K for a batch of queries using the threshold algorithm
+        Queries with the same sign pattern share a single walk over the sorted
+        lists, every new item is scored against all active queries at once
+        and a query drops out as soon as its own threshold is met
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=float))
+        n_queries = queries.shape[0]
+        top_Ks = [None] * n_queries
+        n_items_scored = [0] * n_queries
+        runtimes = [0.0] * n_queries
+        # group the queries by sign pattern, these walk the same lists
+        groups = {}
+        for q, pattern in enumerate(np.sign(queries).astype(int)):
+            groups.setdefault(tuple(pattern), []).append(q)
+        for pattern, members in groups.items():
+            t0 = time()
+            members = np.array(members)
+            top_lists, n_scored = self._threshold_batch_group(
+                    queries[members], np.array(pattern), K)
+            t1 = time()
+            for q, top_list, n in zip(members, top_lists, n_scored):
+                top_Ks[q] = top_list
+                n_items_scored[q] = n
+                runtimes[q] = (t1 - t0) / len(members)  # amortised runtime
+        if count_calculations:
+            return top_Ks, n_items_scored, runtimes
         else:
-            return top_Ks, n_scores_calc, runtimes
+            return top_Ks
+
+    def _threshold_batch_group(self, Q, pattern, K):
+        """
+        Shared threshold walk for queries Q that all have the given sign
+        pattern, returns a top list and the number of scored items per query
+        """
+        n_queries = Q.shape[0]
+        neg_elements = np.flatnonzero(pattern < 0)
+        pos_elements = np.flatnonzero(pattern > 0)
+        if len(neg_elements) + len(pos_elements) == 0:
+            pos_elements = np.array([0])  # zero queries, every score is zero
+        # the K best values and items for each query, in no particular order
+        top_values = np.ones((n_queries, K)) * -1e10
+        top_items = -np.ones((n_queries, K), dtype=int)
+        n_items_scored = np.zeros(n_queries, dtype=int)
+        depths = np.zeros(n_queries, dtype=int)  # depth at which queries stop
+        if len(self.delta_items):
+            scores, delta = self._score_delta(Q.T)
+            top_values, top_items = merge_top_K(top_values, top_items,
+                        scores.T, delta, K)
+            n_items_scored += len(delta)
+        active = np.arange(n_queries)
+        stamps, epoch = self._new_visited()
+        depth = 0
+        while len(active) and depth < len(self.sorted_lists):
+            items = np.concatenate((self.sorted_lists[depth, neg_elements],
+                        self.sorted_lists[-(depth+1), pos_elements]))
+            columns = np.concatenate((neg_elements, pos_elements))
+            Q_active = Q[active]
+            # one upper bound per query, sharing the same items
+            upper_bounds = Q_active[:, columns].dot(np.concatenate((
+                        self.Y_sorted[depth, neg_elements],
+                        self.Y_sorted[-(depth+1), pos_elements])))
+            new_items = np.unique(items[stamps[items] != epoch])
+            if len(new_items):
+                stamps[new_items] = epoch
+                scores = Q_active.dot(self.Y[new_items].T)
+                n_items_scored[active] += len(new_items)
+                # merge the new scores into the top-K of each query
+                top_values[active], top_items[active] = merge_top_K(
+                            top_values[active], top_items[active], scores,
+                            new_items, K)
+            lower_bounds = top_values[active].min(1)
+            depth += 1
+            depths[active] = depth
+            active = active[upper_bounds > lower_bounds]
+        if self.instrumentation is not None:
+            # the walk is shared, only the stopping depths are per query
+            for query in range(n_queries):
+                trace = self._start_trace('batch')
+                if trace is not None:
+                    trace.count_score(n=n_items_scored[query])
+                    self._finish_trace(trace, depths[query],
+                                n_items_scored[query])
+        top_lists = []
+        for values, indices in zip(top_values, top_items):
+            top_list = [(val, ind) if ind >= 0 else (val, )
+                        for val, ind in zip(values, indices)]
+            top_list.sort()
+            top_lists.append(top_list)
+        return top_lists, list(n_items_scored)
 
     def score_item(self, x_u, indice):
         result = 0.0
@@ -153,69 +883,326 @@ class TopKInference():
         Returns top-K for a given query by naively scoring all the items
         """
         t0 = time()
+        trace = self._start_trace('naive')
+        score_item = self.score_item if trace is None else \
+                    trace.timed(self.score_item)
         top_list = [(-1e10,) for i in range(K)]
         n_items_scored = 0
         for indice in range(self.M):
-            new_scored_item = self.score_item(x_u, indice)
+            if self.deleted[indice]:
+                continue
+            new_scored_item = score_item(x_u, indice)
             if top_list[0][0] < new_scored_item[0]:
                 heapreplace(top_list, new_scored_item)
             n_items_scored += 1
         top_list.sort()
+        if trace is not None:
+            trace.count_score(n=n_items_scored)
+            self._finish_trace(trace, None, n_items_scored)
         t1 = time()
         if count_calculations:
             return top_list, n_items_scored, t1 - t0
         else:
             return top_list
 
+    def _walk_lists(self, x_u):
+        """
+        Returns the features and the query elements of the lists that are
+        walked: from the lowest values for negative elements of the query,
+        from the highest values for positive elements
+        """
+        neg_elements = np.flatnonzero(x_u < 0)
+        pos_elements = np.flatnonzero(x_u > 0)
+        if len(neg_elements) + len(pos_elements) == 0:
+            pos_elements = np.array([0])  # zero query, every score is zero
+        return neg_elements, pos_elements
+
     def get_top_K_fagin(self, x_u, K=1, count_calculations=False):
         """
         Returns top-K using Fagin's algorithm
+        The lists are walked until K items have been seen in all of them,
+        only then the items seen are scored
         """
-        top_list = []
-        n_items_scored = 0
+        t0 = time()
+        trace = self._start_trace('fagin')
+        score_items = self._score_items if trace is None else \
+                    trace.timed(self._score_items)
+        neg_elements, pos_elements = self._walk_lists(x_u)
+        n_lists = len(neg_elements) + len(pos_elements)
+        # an item seen in n lists is stamped epoch + n, skipped items epoch
+        stamps, epoch = self._new_visited(n_lists + 1)
+        seen = []
+        n_complete = 0
+        depth = 0
+        while n_complete < K and depth < len(self.sorted_lists):
+            items, counts = np.unique(np.concatenate((
+                        self.sorted_lists[depth, neg_elements],
+                        self.sorted_lists[-(depth+1), pos_elements])),
+                        return_counts=True)
+            previous = stamps[items].astype(np.int64) - epoch
+            items, counts, previous = items[previous != 0], \
+                        counts[previous != 0], previous[previous != 0]
+            seen.append(items[previous < 0])
+            n_seen = np.maximum(previous, 0) + counts
+            stamps[items] = epoch + n_seen
+            # an item appears once per list, so it completes only once
+            n_complete += np.count_nonzero(n_seen == n_lists)
+            depth += 1
+            if trace is not None:
+                trace.step(depth, None, None)
+        # random access to all the items seen
+        seen = np.concatenate(seen) if len(seen) else np.zeros(0, dtype=int)
+        top_values = np.ones(K) * -1e10
+        top_items = -np.ones(K, dtype=int)
+        top_values, top_items = merge_top_K(top_values, top_items,
+                    score_items(x_u, seen), seen, K)
+        n_items_scored = len(seen)
+        if len(self.delta_items):
+            scores, delta = self._score_delta(x_u)
+            top_values, top_items = merge_top_K(top_values, top_items, scores,
+                        delta, K)
+            n_items_scored += len(delta)
+        top_list = [(val, ind) if ind >= 0 else (val, )
+                    for val, ind in zip(top_values, top_items)]
+        top_list.sort()
+        if trace is not None:
+            trace.count_score(n=n_items_scored)
+            self._finish_trace(trace, depth, n_items_scored)
+        t1 = time()
+        if count_calculations:
+            return top_list, n_items_scored, t1 - t0
+        else:
+            return top_list
 
-        # fill in
+    def get_top_K_nra(self, x_u, K=1, count_calculations=False,
+                block_size=None):
+        """
+        Returns top-K using the no random access (NRA) algorithm
+        Only the values found by sorted access are used: every item seen
+        gets a lower bound (the values not yet seen are at least the values at
+        the end of the lists) and an upper bound (they are at most the values
+        at the current depth).
+        The walk stops when no item outside the K best lower bounds can still
+        have a higher score.
+        The items are exact, the scores are lower bounds (exact for items
+        seen in all lists). The delta buffer is in memory and scored directly.
+        The lists are read in blocks, the bounds are updated after every block.
+        When counting calculations, returns the number of items seen
+        """
+        t0 = time()
+        top_list, n_items_seen, n_random = self._combined_walk(x_u, K,
+                    block_size, None, 'nra')
+        t1 = time()
         if count_calculations:
-            return top_list, count_calculations
+            return top_list, n_items_seen, t1 - t0
         else:
             return top_list
 
-    def get_top_K_threshold_profile(self, x_u, K=1, count_calculations=False):
+    def set_access_costs(self, sorted_cost=1.0, random_cost=None):
         """
-        Returns top-K using the threshold algorithm
-        for profiling only, keeps lower bound
+        Sets the costs of a sorted access (one value of a list) and of a
+        random access (scoring an item, by default R values) used by
+        get_top_K_combined
+        """
+        self.sorted_cost = sorted_cost
+        self.random_cost = random_cost
+
+    def get_top_K_combined(self, x_u, K=1, count_calculations=False,
+                block_size=None):
+        """
+        Returns top-K using the combined algorithm (CA)
+        Walks the lists as the NRA algorithm, but every time the sorted
+        accesses have cost as much as a random access, the candidate with the
+        highest upper bound that can still enter the top-K is scored. At the
+        end the K items found are scored, so the scores are exact.
+        A high cost of random access (set_access_costs) postpones scoring.
+        When counting calculations, returns the number of items scored
         """
         t0 = time()
-        top_list = [(-1e10,) for i in range(K)]
-        lower_bounds = []
-        neg_elements_query = set([i for i, el in enumerate(x_u) if el < 0])
-        non_zero_elements_query = [i for i, el in enumerate(x_u) if el != 0]
-        scored = set([])
-        upper_bound = 1
-        lower_bound = top_list[0][0]
+        random_cost = self.random_cost
+        if random_cost is None:
+            random_cost = float(self.R)
+        top_list, n_items_seen, n_items_scored = self._combined_walk(x_u, K,
+                    block_size, random_cost / self.sorted_cost, 'combined')
+        t1 = time()
+        if count_calculations:
+            return top_list, n_items_scored, t1 - t0
+        else:
+            return top_list
+
+    def _combined_walk(self, x_u, K, block_size=None, cost_ratio=None,
+                engine='combined'):
+        """
+        Walk of get_top_K_combined, with cost_ratio the cost of a random
+        access in sorted accesses, or get_top_K_nra when cost_ratio is None
+        Returns the top list, the number of items seen and the number of
+        items scored
+        """
+        trace = self._start_trace(engine)
+        score_items = self._score_items if trace is None else \
+                    trace.timed(self._score_items)
+        if block_size is None:
+            block_size = self.block_size
+        neg_elements, pos_elements = self._walk_lists(x_u)
+        columns = np.concatenate((neg_elements, pos_elements))
+        x_columns = x_u[columns]
+        list_numbers = np.arange(len(columns))
+        # lowest values of the lists, for the lower bounds
+        bottom = x_columns * np.concatenate((self.Y_sorted[-1, neg_elements],
+                    self.Y_sorted[0, pos_elements]))
+        bottom_sum = bottom.sum()
+        # skipped items are stamped epoch, candidates epoch + 1; the state of
+        # a candidate is kept at its slot, in the order in which it was seen,
+        # in arrays that double their capacity when full
+        stamps, epoch = self._new_visited(2)
+        slots = self._candidate_slots()
+        capacity = block_size * len(columns)
+        candidates = np.empty(capacity, dtype=int)
+        # values seen plus the lowest values of the lists not seen
+        lower = np.empty(capacity)
+        seen = np.empty((capacity, len(columns)), dtype=bool)
+        in_top = np.empty(capacity, dtype=bool)
+        n_candidates = 0
+        # the K best lower bounds, by slot
+        top_values = np.ones(K) * -1e10
+        top_slots = -np.ones(K, dtype=int)
+        n_items_scored = 0
+        if len(self.delta_items):
+            # the items of the delta buffer are candidates with exact scores
+            delta_scores, delta = self._score_delta(x_u)
+            n_candidates = len(delta)
+            candidates, lower, seen, in_top = [grow_rows(array, n_candidates)
+                        for array in (candidates, lower, seen, in_top)]
+            candidates[:n_candidates] = delta
+            lower[:n_candidates] = delta_scores
+            seen[:n_candidates] = True
+            in_top[:n_candidates] = False
+            top_values, top_slots = update_top_K(top_values, top_slots,
+                        in_top, lower, np.arange(n_candidates), K)
+            n_items_scored = len(delta)
+        lower_bound = top_values.min()
+        # candidates that may still enter the top-K, upper bounds only
+        # decrease and the lower bound only increases, so a candidate that
+        # fails once is dropped for good; new ones are added when checked
+        alive = np.zeros(0, dtype=int)
+        new_slots = []
+        credit = 0.0  # cost of the sorted accesses not yet spent
+        N = len(self.sorted_lists)
         depth = 0
-        while upper_bound > lower_bound:
-            upper_bound = 0
-            for r in non_zero_elements_query:
-                if r in neg_elements_query:
-                    item = self.sorted_lists[depth, r]  # negative, so start from
-                            # items with the LOWEST score for this item
-                else:
-                    item = self.sorted_lists[-(depth+1), r]
-                    # update upper bound
-                upper_bound += self.Y[item, r] * x_u[r]
-                if item not in scored:
-                    new_scored_item = self.score_item(x_u, item)
-                    if lower_bound < new_scored_item[0]:
-                        heapreplace(top_list, new_scored_item)
-                        lower_bound = top_list[0][0]
-                    scored.add(item)
-                    lower_bounds.append(top_list[0][0])
-            depth += 1
+        while depth < N:
+            end = min(depth + block_size, N)
+            # one row per depth, one column per list
+            items = np.hstack((self.sorted_lists[depth:end, neg_elements],
+                        self.sorted_lists[N-end:N-depth, pos_elements][::-1]))
+            values = x_columns * np.hstack((
+                        self.Y_sorted[depth:end, neg_elements],
+                        self.Y_sorted[N-end:N-depth, pos_elements][::-1]))
+            frontier = values[-1]  # values at the current depth
+            threshold = frontier.sum()  # upper bound for the unseen items
+            lists = np.broadcast_to(list_numbers, items.shape)
+            new_items = np.unique(items[stamps[items] < epoch])
+            if len(new_items):
+                n_total = n_candidates + len(new_items)
+                candidates, lower, seen, in_top = [grow_rows(array, n_total)
+                            for array in (candidates, lower, seen, in_top)]
+                stamps[new_items] = epoch + 1
+                slots[new_items] = np.arange(n_candidates, n_total)
+                candidates[n_candidates:n_total] = new_items
+                lower[n_candidates:n_total] = bottom_sum
+                seen[n_candidates:n_total] = False
+                in_top[n_candidates:n_total] = False
+                new_slots.append(np.arange(n_candidates, n_total))
+                n_candidates = n_total
+            # items scored by random access are already known
+            keep = stamps[items] != epoch
+            item_slots = slots[items[keep]]
+            keep[keep] = ~seen[item_slots, lists[keep]]
+            item_slots = slots[items[keep]]
+            np.add.at(lower, item_slots, (values - bottom)[keep])
+            seen[item_slots, lists[keep]] = True
+            top_values, top_slots = update_top_K(top_values, top_slots,
+                        in_top, lower, np.unique(item_slots), K)
+            lower_bound = top_values.min()
+            depth = end
+            if cost_ratio is not None:
+                credit += items.size / cost_ratio
+            done = False
+            while True:
+                if threshold > lower_bound and credit < 1:
+                    break
+                if len(new_slots):
+                    alive = np.concatenate([alive] + new_slots)
+                    new_slots = []
+                # upper bounds of the candidates, only for those that pass
+                # the looser bound with all lists unseen
+                alive = alive[lower[alive] + threshold - bottom_sum >
+                            lower_bound]
+                upper_bounds = lower[alive] + \
+                            (~seen[alive]).dot(frontier - bottom)
+                alive = alive[upper_bounds > lower_bound]
+                upper_bounds = upper_bounds[upper_bounds > lower_bound]
+                # those not in the top-K
+                entering = ~in_top[alive]
+                others = alive[entering]
+                if credit >= 1 and len(others):
+                    # random access to the highest upper bounds, after which
+                    # the bounds are checked again
+                    n_random = min(int(credit), len(others))
+                    best = others[np.argsort(-upper_bounds[entering],
+                                kind='mergesort')[:n_random]]
+                    lower[best] = score_items(x_u, candidates[best])
+                    seen[best] = True
+                    n_items_scored += n_random
+                    credit -= n_random
+                    top_values, top_slots = update_top_K(top_values,
+                                top_slots, in_top, lower, best, K)
+                    lower_bound = top_values.min()
+                    continue
+                done = threshold <= lower_bound and len(others) == 0
+                break
+            if trace is not None:
+                trace.step(depth, threshold, lower_bound)
+            if done:
+                break
+        if cost_ratio is not None:
+            # exact scores for the K items found
+            unknown = top_slots[top_slots >= 0]
+            unknown = unknown[~seen[unknown].all(1)]
+            if len(unknown):
+                lower[unknown] = score_items(x_u, candidates[unknown])
+                seen[unknown] = True
+                n_items_scored += len(unknown)
+                top_values, top_slots = update_top_K(top_values, top_slots,
+                            in_top, lower, unknown, K)
+        top_items = np.where(top_slots >= 0, candidates[top_slots], -1)
+        top_list = [(val, ind) if ind >= 0 else (val, )
+                    for val, ind in zip(top_values, top_items)]
         top_list.sort()
-        t1 = time()
+        n_items_seen = n_candidates
+        if trace is not None:
+            trace.count_score(partial=True, n=n_items_seen - n_items_scored)
+            trace.count_score(n=n_items_scored)
+            self._finish_trace(trace, depth, n_items_seen)
+        return top_list, n_items_seen, n_items_scored
+
+    def get_top_K_threshold_profile(self, x_u, K=1, count_calculations=False):
+        """
+        Returns top-K using the threshold algorithm
+        for profiling only, keeps the lower bound after every depth
+        (taken from the bound trajectory of an instrumentation trace)
+        """
+        sink = MemorySink(1)
+        instrumentation = self.instrumentation
+        self.instrumentation = Instrumentation(sink, time_access=False)
+        try:
+            top_list, n_items_scored, runtime = self.get_top_K_threshold(x_u,
+                        K, True)
+        finally:
+            self.instrumentation = instrumentation
+        lower_bounds = [lower_bound for depth, upper_bound, lower_bound
+                    in sink.records[-1]['bound_trajectory']]
         if count_calculations:
-            return top_list, lower_bounds, t1 - t0
+            return top_list, lower_bounds, runtime
         else:
             return top_list
 
@@ -224,33 +1211,42 @@ class TopKInference():
         Returns top-K using the threshold algorithm
         """
         t0 = time()
-        top_list = [(-1e10,) for i in range(K)]
-        n_items_scored = 0
+        trace = self._start_trace('threshold')
+        score_item = self.score_item if trace is None else \
+                    trace.timed(self.score_item)
+        top_list = self._initial_top_list(x_u, K)
+        n_items_scored = len(self.delta_items)
         neg_elements_query = set([i for i, el in enumerate(x_u) if el < 0])
         non_zero_elements_query = [i for i, el in enumerate(x_u) if el != 0]
-        scored = set([])
-        upper_bound = 1
+        stamps, epoch = self._new_visited()
+        upper_bound = 1e10
         lower_bound = top_list[0][0]
         depth = 0
-        while upper_bound > lower_bound:
+        while upper_bound > lower_bound and depth < len(self.sorted_lists):
             upper_bound = 0
             for r in non_zero_elements_query:
                 if r in neg_elements_query:
-                    item = self.sorted_lists[depth, r]  # negative, so start from
+                    position = depth  # negative, so start from
                             # items with the LOWEST score for this item
                 else:
-                    item = self.sorted_lists[-(depth+1), r]
-                    # update upper bound
-                upper_bound += self.Y[item, r] * x_u[r]
-                if item not in scored:
-                    new_scored_item = self.score_item(x_u, item)
+                    position = -(depth+1)
+                item = self.sorted_lists[position, r]
+                # update upper bound
+                upper_bound += self.Y_sorted[position, r] * x_u[r]
+                if stamps[item] != epoch:
+                    new_scored_item = score_item(x_u, item)
                     if lower_bound < new_scored_item[0]:
                         heapreplace(top_list, new_scored_item)
                         lower_bound = top_list[0][0]
                     n_items_scored += 1
-                    scored.add(item)
+                    stamps[item] = epoch
             depth += 1
+            if trace is not None:
+                trace.step(depth, upper_bound, lower_bound)
         top_list.sort()
+        if trace is not None:
+            trace.count_score(n=n_items_scored)
+            self._finish_trace(trace, depth, n_items_scored)
         t1 = time()
         if count_calculations:
             return top_list, n_items_scored, t1 - t0
@@ -262,42 +1258,53 @@ class TopKInference():
         Returns top-K using the modified threshold algorithm
         """
         t0 = time()
-        top_list = [(-1e10,) for i in range(K)]
-        n_items_scored = 0
+        trace = self._start_trace('enhanced')
+        score_item = self.score_item if trace is None else \
+                    trace.timed(self.score_item)
+        top_list = self._initial_top_list(x_u, K)
+        n_items_scored = len(self.delta_items)
+        n_sorted_accesses = 0
+        N = len(self.sorted_lists)
         # initiate list with rules
         # contains tuples with
         # (-paritial score, xi, r, position_sorted_list, decr/incr sorted)
         # note negetive partial score for the heap!
-        query_info_list = [(-calculate_partial_score(r, 0, xi, self.Y, self.sorted_lists),
+        query_info_list = [(-xi * self.Y_sorted[0 if xi < 0 else N - 1, r],
                         xi,
                         r,
-                        0 if xi < 0 else self.M - 1,
+                        0 if xi < 0 else N - 1,
                         1 if xi < 0 else -1)\
                 for r, xi in enumerate(x_u) if xi != 0]
         heapify(query_info_list)  # turn in a heap in O(R) time
-        scored = set([])
+        stamps, epoch = self._new_visited()
         #  we start with the upper bound which we update iteratively
         upper_bound = sum([-x[0] for x in query_info_list])
-        while upper_bound > top_list[0][0]:
+        while upper_bound > top_list[0][0] and len(query_info_list):
             partial_score, xi, r, pos, pos_action = heappop(query_info_list)
             # get item
             item = self.sorted_lists[pos, r]
+            n_sorted_accesses += 1
             # score item
-            if item not in scored:
-                new_scored_item = self.score_item(x_u, item)
+            if stamps[item] != epoch:
+                new_scored_item = score_item(x_u, item)
                 if top_list[0][0] < new_scored_item[0]:
                     heapreplace(top_list, new_scored_item)
                 n_items_scored += 1
-                scored.add(item)
+                stamps[item] = epoch
             # update position for this list
             pos += pos_action
-            if pos < self.M and pos >= 0:
+            if pos < N and pos >= 0:
                 # update the upper bound
                 upper_bound += partial_score  # remove previous partial score (neg)
-                partial_score = xi * self.Y[item, r]  # get new partial score
+                partial_score = xi * self.Y_sorted[pos, r]  # get new partial score
                 upper_bound += partial_score
                 heappush(query_info_list, (-partial_score, xi, r, pos, pos_action))
+            if trace is not None:
+                trace.step(n_sorted_accesses, upper_bound, top_list[0][0])
         top_list.sort()
+        if trace is not None:
+            trace.count_score(n=n_items_scored)
+            self._finish_trace(trace, n_sorted_accesses, n_items_scored)
         t1 = time()
         if count_calculations:
             return top_list, n_items_scored, t1 - t0
@@ -310,112 +1317,467 @@ class TopKInference():
         Returns top-K using the threshold algorithm
         """
         t0 = time()
-        top_list = [(-1e10,) for i in range(K)]
-        n_calculations = 0.0
+        trace = self._start_trace('partial')
+        partial_score_item = self.partial_score_item if trace is None else \
+                    trace.timed(self.partial_score_item)
+        top_list = self._initial_top_list(x_u, K)
+        n_calculations = float(len(self.delta_items) * self.R)
+        n_items_scored = len(self.delta_items)
         neg_elements_query = set([i for i, el in enumerate(x_u) if el < 0])
         non_zero_elements_query = [i for i, el in enumerate(x_u) if el != 0]
-        scored = set([])
+        stamps, epoch = self._new_visited()
         depth = 0
         partials = [0] * self.R
         upper_bound = 1e10
         lower_bound = top_list[0][0]
         to_score = set([])
-        while upper_bound > lower_bound:
+        while upper_bound > lower_bound and depth < len(self.sorted_lists):
             upper_bound = 0.0
             for r in non_zero_elements_query:
                 if r in neg_elements_query:
-                    item = self.sorted_lists[depth, r]  # negative, so start from
+                    position = depth  # negative, so start from
                     # items with the LOWEST score for this item
                 else:
-                    item = self.sorted_lists[-(depth+1), r]
-                to_score.add(item)
+                    position = -(depth+1)
+                to_score.add(self.sorted_lists[position, r])
                 # get partial score for this item/position
-                pr = self.Y[item, r] * x_u[r]
+                pr = self.Y_sorted[position, r] * x_u[r]
                 partials[r] = pr
                 upper_bound += pr
             while len(to_score):
                 item = to_score.pop()
-                if item not in scored:
-                    new_scored_item, n_calc = self.partial_score_item(x_u,
+                if stamps[item] != epoch:
+                    new_scored_item, n_calc = partial_score_item(x_u,
                             item, upper_bound, lower_bound, partials)
                     if new_scored_item[0] > lower_bound:
                         heapreplace(top_list, new_scored_item)
                         lower_bound = top_list[0][0]
                     n_calculations += n_calc
-                    scored.add(item)
+                    n_items_scored += 1
+                    stamps[item] = epoch
+                    if trace is not None:
+                        trace.count_score(partial=n_calc < self.R)
             depth += 1
+            if trace is not None:
+                trace.step(depth, upper_bound, lower_bound)
         top_list.sort()
+        self._finish_trace(trace, depth, n_items_scored)
         t1 = time()
         if count_calculations:
             return top_list, n_calculations/self.R, t1 - t0
         else:
             return top_list
 
+    def get_top_K_threshold_block(self, x_u, K=1, count_calculations=False,
+                block_size=None, exchange_bound=None):
+        """
+        Returns top-K using the threshold algorithm, advancing block_size
+        depths at a time: all new items in a block are scored at once and the
+        upper bound is only checked at the end of each block
+        exchange_bound is an optional function that receives the lower bound
+        at the end of each block and returns a (higher) bound known from
+        elsewhere, e.g. other shards, at which the search can stop
+        """
+        t0 = time()
+        top_list, n_items_scored, gap = self._threshold_block_walk(x_u, K,
+                    block_size, exchange_bound=exchange_bound)
+        t1 = time()
+        if count_calculations:
+            return top_list, n_items_scored, t1 - t0
+        else:
+            return top_list
+
+    def get_top_K_anytime(self, x_u, K=1, count_calculations=False,
+                max_items=None, max_time=None, epsilon=None, block_size=None):
+        """
+        Returns an approximate top-K using the block threshold algorithm,
+        which stops early when more than max_items are scored, after max_time
+        seconds or when the gap between the bounds is within a fraction
+        epsilon of the lower bound
+        Also returns the remaining gap between the upper and lower bound: no
+        missing item scores more than the gap above the K-th returned score
+        (a gap of zero means the result is exact)
+        Budgets are checked at the end of each block
+        """
+        t0 = time()
+        if max_time is not None:
+            max_time += t0
+        top_list, n_items_scored, gap = self._threshold_block_walk(x_u, K,
+                    block_size, max_items=max_items, deadline=max_time,
+                    epsilon=epsilon, engine='anytime')
+        t1 = time()
+        if count_calculations:
+            return top_list, gap, n_items_scored, t1 - t0
+        else:
+            return top_list, gap
+
+    def _score_items(self, x_u, items):
+        return self.Y[items].dot(x_u)
+
+    def _threshold_block_walk(self, x_u, K, block_size=None,
+                exchange_bound=None, max_items=None, deadline=None,
+                epsilon=None, engine='block'):
+        """
+        Block threshold walk used by get_top_K_threshold_block and
+        get_top_K_anytime, returns the top list, the number of items scored
+        and the remaining gap between the upper and the lower bound
+        With norm buckets, candidates with ||x|| ||y|| at most the lower
+        bound are not scored and the upper bound is at most ||x|| times the
+        largest norm of the items not seen yet
+        """
+        trace = self._start_trace(engine)
+        score_items = self._score_items if trace is None else \
+                    trace.timed(self._score_items)
+        if block_size is None:
+            block_size = self.block_size
+        x_u = np.asarray(x_u, dtype=float)
+        top_values = np.ones(K) * -1e10
+        top_items = -np.ones(K, dtype=int)
+        n_items_scored = 0
+        if len(self.delta_items):
+            scores, delta = self._score_delta(x_u)
+            top_values, top_items = merge_top_K(top_values, top_items,
+                        scores, delta, K)
+            n_items_scored += len(delta)
+        neg_elements_query = np.flatnonzero(x_u < 0)
+        pos_elements_query = np.flatnonzero(x_u > 0)
+        if len(neg_elements_query) + len(pos_elements_query) == 0:
+            pos_elements_query = np.array([0])  # zero query, all scores zero
+        stamps, epoch = self._new_visited()
+        if self.norm_order is not None:
+            x_norm = np.sqrt(x_u.dot(x_u))
+            norm_position = 0  # in norm_order, before it all items are seen
+        upper_bound = 1e10
+        lower_bound = top_values.min()
+        stop_bound = lower_bound
+        N = len(self.sorted_lists)
+        depth = 0
+        while upper_bound > stop_bound and depth < N:
+            end = min(depth + block_size, N)
+            # negative, so start from the items with the LOWEST score
+            neg_block = self.sorted_lists[depth:end, neg_elements_query]
+            pos_block = self.sorted_lists[N-end:N-depth, pos_elements_query]
+            candidates = np.unique(np.concatenate((neg_block.ravel(),
+                        pos_block.ravel())))
+            candidates = candidates[stamps[candidates] != epoch]
+            stamps[candidates] = epoch
+            if self.norm_order is not None:
+                # Cauchy-Schwarz: these can not exceed the lower bound
+                candidates = candidates[x_norm *
+                            self.item_norms[candidates] > lower_bound]
+            if len(candidates):
+                scores = score_items(x_u, candidates)
+                n_items_scored += len(candidates)
+                # merge the new scores with the current top-K
+                top_values, top_items = merge_top_K(top_values, top_items,
+                            scores, candidates, K)
+                lower_bound = top_values.min()
+            # upper bound with the last item of the block in each list
+            upper_bound = dot(x_u[neg_elements_query],
+                        self.Y_sorted[end-1, neg_elements_query])
+            upper_bound += dot(x_u[pos_elements_query],
+                        self.Y_sorted[N-end, pos_elements_query])
+            if self.norm_order is not None:
+                norm_position = self._next_unseen(norm_position, stamps, epoch)
+                if norm_position < len(self.norm_order):
+                    upper_bound = min(upper_bound, x_norm *
+                                self.item_norms[self.norm_order[norm_position]])
+                else:
+                    upper_bound = -np.inf  # all items are seen
+            if exchange_bound is not None:
+                stop_bound = max(lower_bound, exchange_bound(lower_bound))
+            else:
+                stop_bound = lower_bound
+            depth = end
+            if trace is not None:
+                trace.step(depth, upper_bound, lower_bound)
+            # budgets of the approximate mode
+            if max_items is not None and n_items_scored >= max_items:
+                break
+            if deadline is not None and time() >= deadline:
+                break
+            if epsilon is not None and \
+                    upper_bound - lower_bound <= epsilon * abs(lower_bound):
+                break
+        if depth >= N:
+            gap = 0.0  # all items are scored
+        else:
+            gap = max(0.0, upper_bound - stop_bound)
+        top_list = [(val, ind) if ind >= 0 else (val, )
+                    for val, ind in zip(top_values, top_items)]
+        top_list.sort()
+        if trace is not None:
+            trace.count_score(n=n_items_scored)
+            self._finish_trace(trace, depth, n_items_scored)
+        return top_list, n_items_scored, gap
+
+    def _next_unseen(self, position, stamps, epoch, window=256):
+        """
+        First position from position onwards in norm_order of an item that
+        is not yet seen
+        """
+        while position < len(self.norm_order):
+            unseen = np.flatnonzero(stamps[self.norm_order[position:
+                        position + window]] != epoch)
+            if len(unseen):
+                return position + unseen[0]
+            position += window
+        return position
+
+    def get_top_K_norm(self, x_u, K=1, count_calculations=False):
+        """
+        Returns top-K by scoring the norm buckets in order of decreasing
+        norm: a bucket is skipped when its bound, the smallest of ||x||
+        times its largest norm and the bound from its smallest and largest
+        values per feature, does not exceed the lower bound, and the search
+        stops as soon as ||x|| times the largest norm does not
+        The index needs norm buckets (bucket_size or initialize_norm_buckets)
+        """
+        if self.norm_order is None:
+            raise ValueError('get_top_K_norm needs norm buckets, build the '
+                        'index with a bucket_size or call '
+                        'initialize_norm_buckets')
+        t0 = time()
+        trace = self._start_trace('norm')
+        score_items = self._score_items if trace is None else \
+                    trace.timed(self._score_items)
+        x_u = np.asarray(x_u, dtype=float)
+        top_values = np.ones(K) * -1e10
+        top_items = -np.ones(K, dtype=int)
+        n_items_scored = 0
+        if len(self.delta_items):
+            scores, delta = self._score_delta(x_u)
+            top_values, top_items = merge_top_K(top_values, top_items, scores,
+                        delta, K)
+            n_items_scored += len(delta)
+        stamps, epoch = self._new_visited()
+        x_norm = np.sqrt(x_u.dot(x_u))
+        # bounds of all buckets at once, cheaper than bucket by bucket
+        norm_bounds = x_norm * self.bucket_norms
+        bounds = np.minimum(norm_bounds,
+                    self.bucket_max.dot(np.maximum(x_u, 0)) +
+                    self.bucket_min.dot(np.minimum(x_u, 0)))
+        lower_bound = top_values.min()
+        n_buckets = 0
+        for bucket in range(len(self.bucket_norms)):
+            if norm_bounds[bucket] <= lower_bound:
+                break  # the norms only decrease
+            n_buckets += 1
+            if bounds[bucket] > lower_bound:
+                items = self.norm_order[self.bucket_ptr[bucket]:
+                            self.bucket_ptr[bucket + 1]]
+                # deleted or updated
+                items = items[(stamps[items] != epoch) & ~self.deleted[items]]
+                scores = score_items(x_u, items)
+                n_items_scored += len(items)
+                top_values, top_items = merge_top_K(top_values, top_items,
+                            scores, items, K)
+                lower_bound = top_values.min()
+            if trace is not None:
+                trace.step(n_buckets, bounds[bucket], lower_bound)
+        top_list = [(val, ind) if ind >= 0 else (val, )
+                    for val, ind in zip(top_values, top_items)]
+        top_list.sort()
+        if trace is not None:
+            trace.count_score(n=n_items_scored)
+            self._finish_trace(trace, n_buckets, n_items_scored)
+        t1 = time()
+        if count_calculations:
+            return top_list, n_items_scored, t1 - t0
+        else:
+            return top_list
+
+    def tune_block_size(self, queries, K=1,
+                block_sizes=(1, 4, 16, 64, 256, 1024)):
+        """
+        Sets the block size of the block threshold algorithm to the one with
+        the lowest mean runtime for the given (sample of) queries
+        """
+        mean_runtimes = []
+        for block_size in block_sizes:
+            runtimes = [self.get_top_K_threshold_block(x_u, K, True,
+                        block_size)[2] for x_u in queries]
+            mean_runtimes.append(np.mean(runtimes))
+        self.block_size = block_sizes[int(np.argmin(mean_runtimes))]
+        return self.block_size
+
 class TopKInferenceSparse(TopKInference):
     """
     A module collecting different algorithms to find the top-K for a given
     query and SEP-LR model.
-    This class is designed for dense matrices, for which the elements are
+    This class is designed for sparse matrices, for which the elements are
     positive.
+    The sorted lists are stored as arrays: for each latent feature r the
+    postings (values and rows) sorted in decreasing order are found at
+    positions postings_ptr[r]:postings_ptr[r+1], Y is kept in CSR format
+    for scoring the items
+    For WAND and Block-Max WAND the same positions of doc_values and
+    doc_rows hold the postings in increasing order of the rows, split in
+    blocks of block_size postings; the blocks of feature r are
+    blocks_ptr[r]:blocks_ptr[r+1] with their last row and maximal value
+    compress_postings replaces these by a compressed copy (see postings.py)
     """
     def initialize_sorted_lists(self):
         """
         Makes for each latent feature a list of the sorted indices for each item
         """
-        self.Y = self.Y.tocoo()
-        self.sorted_lists = {r:[] for r in range(self.R)}
-        [self.sorted_lists[self.Y.col[i]].append( (self.Y.data[i], self.Y.row[i])) for i in xrange(self.Y.nnz) ]
-        [self.sorted_lists[r].sort() for r in range(self.R)]
-        [self.sorted_lists[r].reverse() for r in range(self.R)]
-        self.Ycompr = {i : {} for i in range(self.M)}
-        for val, row, col in zip(self.Y.data, self.Y.row, self.Y.col):
-            self.Ycompr[row][col] = val
-        del self.Y
+        self.Y = self.Y.tocsr()
+        Ycsc = self.Y.tocsc()
+        Ycsc.sum_duplicates()
+        columns = np.repeat(np.arange(self.R), np.diff(Ycsc.indptr))
+        # per column: decreasing value, ties by decreasing row
+        order = np.lexsort((-Ycsc.indices, -Ycsc.data, columns))
+        self.postings_values = Ycsc.data[order]
+        self.postings_rows = Ycsc.indices[order]
+        self.postings_ptr = Ycsc.indptr.copy()
+        self.initialize_block_postings(Ycsc)
 
-    def score_item(self, x_u, indice):
+    def initialize_block_postings(self, Ycsc):
         """
-        Scores an item (sparse vector multiplication)
+        Makes for each latent feature the postings in increasing order of
+        the rows, in blocks with their last row and maximal value
+        """
+        Ycsc.sort_indices()
+        self.doc_values = Ycsc.data
+        self.doc_rows = Ycsc.indices
+        n_blocks = (np.diff(Ycsc.indptr) + self.block_size - 1) \
+                    // self.block_size
+        self.blocks_ptr = np.concatenate(([0], np.cumsum(n_blocks)))
+        block_columns = np.repeat(np.arange(self.R), n_blocks)
+        block_starts = Ycsc.indptr[block_columns] + self.block_size * \
+                    (np.arange(len(block_columns)) - self.blocks_ptr[block_columns])
+        block_ends = np.minimum(block_starts + self.block_size,
+                    Ycsc.indptr[block_columns + 1])
+        self.block_starts = np.concatenate((block_starts, [len(self.doc_rows)]))
+        self.block_last = self.doc_rows[block_ends - 1]
+        self.block_max = np.maximum.reduceat(self.doc_values, block_starts) \
+                    if len(block_starts) else np.zeros(0)
+        # maximal value of every feature, the bound of WAND
+        self.feature_max = np.zeros(self.R)
+        non_empty = n_blocks > 0
+        self.feature_max[non_empty] = np.maximum.reduceat(self.block_max,
+                    self.blocks_ptr[:-1][non_empty])
+        self.compressed = False
+        self.packed_rows = np.zeros(0, dtype=np.uint8)
+        self.block_offsets = np.zeros(0, dtype=np.int64)
+        self.block_bits = np.zeros(0, dtype=np.uint8)
+        self.block_first = np.zeros(0, dtype=self.doc_rows.dtype)
+        self.impacts = np.zeros(0, dtype=np.uint8)
+
+    def compress_postings(self, keep_sorted_lists=True):
+        """
+        Replaces the postings in order of the rows by a compressed copy:
+        per block the first row and the bit-packed differences between the
+        rows, and the values quantized to a byte of the block maximum
+        The WAND engines stay exact, as items are scored from Y. Without
+        keep_sorted_lists the postings of the threshold engines are dropped
+        too, only the WAND engines can then be used
+        """
+        self.block_first, self.block_bits, self.block_offsets, \
+                    self.packed_rows = compress_rows(self.doc_rows,
+                    self.block_starts)
+        self.impacts = quantize_impacts(self.doc_values, self.block_starts,
+                    self.block_max)
+        self.doc_rows = np.zeros(0, dtype=self.doc_rows.dtype)
+        self.doc_values = np.zeros(0)
+        if not keep_sorted_lists:
+            self.postings_values = None
+            self.postings_rows = None
+        self.compressed = True
+
+    def _check_postings(self, algorithm):
+        if self.postings_values is None:
+            raise ValueError('The %s algorithm needs the sorted postings, '
+                        'these were dropped by compress_postings, call it '
+                        'with keep_sorted_lists=True' % algorithm)
+
+    def query_accumulator(self, x_u):
+        """
+        Returns the query as a dense vector and its non-zero elements
+        (values, features), computed once per query
         """
-        score = 0.0
         x_u = x_u.tocoo()
-        for i, v in zip(x_u.row, x_u.data):
-            if self.Ycompr[indice].has_key(i):
-                score += v * self.Ycompr[indice][i]
+        x_dense = np.zeros(self.R)
+        np.add.at(x_dense, x_u.col, x_u.data)
+        non_zero = np.flatnonzero(x_dense)
+        return x_dense, x_dense[non_zero], non_zero
+
+    def score_row(self, x_dense, indice):
+        """
+        Scores an item using the dense query vector
+        """
+        start, stop = self.Y.indptr[indice], self.Y.indptr[indice + 1]
+        score = dot(self.Y.data[start:stop], x_dense[self.Y.indices[start:stop]])
         return (score, indice)
 
+    def score_item(self, x_u, indice):
+        """
+        Scores an item (sparse vector multiplication)
+        """
+        return self.score_row(self.query_accumulator(x_u)[0], indice)
+
+    def get_top_K_naive(self, x_u, K=1, count_calculations=False):
+        """
+        Returns top-K for a given query by naively scoring all the items
+        """
+        t0 = time()
+        trace = self._start_trace('sparse_naive')
+        top_list = [(-1e10,) for i in range(K)]
+        scores = self.Y.dot(self.query_accumulator(x_u)[0])
+        for indice, score in enumerate(scores):
+            if top_list[0][0] < score:
+                heapreplace(top_list, (score, indice))
+        top_list.sort()
+        if trace is not None:
+            trace.count_score(n=self.M)
+            self._finish_trace(trace, None, self.M)
+        t1 = time()
+        if count_calculations:
+            return top_list, self.M, t1 - t0
+        else:
+            return top_list
+
     def get_top_K_threshold(self, x_u, K=1, count_calculations=False):
         """
         Returns top-K using the threshold algorithm, suited for sparse data
         """
+        self._check_postings('threshold')
         t0 = time()
-        x_u = x_u.tocoo()
+        trace = self._start_trace('sparse_threshold')
+        score_row = self.score_row if trace is None else \
+                    trace.timed(self.score_row)
+        x_dense, x_values, x_features = self.query_accumulator(x_u)
         top_list = [(-1e10,) for i in range(K)]
         n_items_scored = 0
-        non_zero_elements_query = [(xi, i) for i, xi in zip(x_u.col, x_u.data)]
-        scored = set([])
+        starts = self.postings_ptr[x_features]
+        lengths = self.postings_ptr[x_features + 1] - starts
+        stamps, epoch = self._new_visited()
         depth = 0
         upper_bound = 1e10
-        break_loop = False
-        if len(non_zero_elements_query) == 0:
+        if len(x_features) == 0:
             upper_bound = -1  # break when no x
         while upper_bound > top_list[0][0]:
-            upper_bound = 0
-            break_loop = True
-            for xi, r in non_zero_elements_query:
-                if len(self.sorted_lists[r]) > depth:
-                    break_loop = False
-                    yir, item = self.sorted_lists[r][depth]
-                    upper_bound += xi * yir
-                    if item not in scored:
-                        new_scored_item = self.score_item(x_u, item)
-                        scored.add(item)
-                        if new_scored_item[0] > top_list[0][0]:
-                            heapreplace(top_list, new_scored_item)
-                        n_items_scored += 1
-            depth += 1
-            if break_loop:
+            # lists that still have elements at this depth
+            in_list = lengths > depth
+            if not in_list.any():
                 break
+            positions = starts[in_list] + depth
+            upper_bound = dot(x_values[in_list],
+                        self.postings_values[positions])
+            for item in self.postings_rows[positions]:
+                if stamps[item] != epoch:
+                    new_scored_item = score_row(x_dense, item)
+                    stamps[item] = epoch
+                    if new_scored_item[0] > top_list[0][0]:
+                        heapreplace(top_list, new_scored_item)
+                    n_items_scored += 1
+            depth += 1
+            if trace is not None:
+                trace.step(depth, upper_bound, top_list[0][0])
         top_list.sort()
+        if trace is not None:
+            trace.count_score(n=n_items_scored)
+            self._finish_trace(trace, depth, n_items_scored)
         t1 = time()
         if count_calculations:
             return top_list, n_items_scored, t1 - t0
@@ -426,54 +1788,140 @@ class TopKInferenceSparse(TopKInference):
         """
         Returns top-K using the modified threshold algorithm, suited for sparse data
         """
+        self._check_postings('enhanced')
         t0 = time()
-        x_u = x_u.tocoo()
+        trace = self._start_trace('sparse_enhanced')
+        score_row = self.score_row if trace is None else \
+                    trace.timed(self.score_row)
+        x_dense, x_values, x_features = self.query_accumulator(x_u)
         top_list = [(-1e10,) for i in range(K)]
         n_items_scored = 0
+        n_sorted_accesses = 0
         # initiate list with rules
         # contains tuples with
-        # (-paritial score, xi, r, position_sorted_list)
+        # (-paritial score, xi, position in the postings, end of the postings)
         # note negetive partial score for the heap!
-        query_info_list = [( - xi * self.sorted_lists[r][0][0],
+        query_info_list = [(-xi * self.postings_values[self.postings_ptr[r]],
                         xi,
-                        r,
-                        0)\
-                for r, xi in zip(x_u.col, x_u.data)\
-                if len(self.sorted_lists[r][0]) > 0]
+                        self.postings_ptr[r],
+                        self.postings_ptr[r + 1])\
+                for r, xi in zip(x_features, x_values)\
+                if self.postings_ptr[r + 1] > self.postings_ptr[r]]
         heapify(query_info_list)  # turn in a heap in O(R) time
-        scored = set([])
+        stamps, epoch = self._new_visited()
         #  we start with the upper bound which we update iteratively
         upper_bound = sum([-x[0] for x in query_info_list])
-        lower_bound = -1e100
         while upper_bound > top_list[0][0]:
             if len(query_info_list) == 0:
                 break
-            partial_score, xi, r, pos = heappop(query_info_list)
+            partial_score, xi, pos, end = heappop(query_info_list)
             # get item
-            item = self.sorted_lists[r][pos][1]
+            item = self.postings_rows[pos]
             # score item
-            if item not in scored:
-                new_scored_item = self.score_item(x_u, item)
+            if stamps[item] != epoch:
+                new_scored_item = score_row(x_dense, item)
                 if new_scored_item[0] > top_list[0][0]:
                     heapreplace(top_list, new_scored_item)
                 n_items_scored += 1
-                scored.add(item)
+                stamps[item] = epoch
+            n_sorted_accesses += 1
             # update position for this list
             pos += 1
             # update the upper bound
             upper_bound += partial_score  # remove previous partial score (neg)
             # update the rule list
-            if pos < len(self.sorted_lists[r]):  # if there are still non-zero elements...
-                partial_score = xi * self.sorted_lists[r][pos][0]  # get new partial score
+            if pos < end:  # if there are still non-zero elements...
+                partial_score = xi * self.postings_values[pos]  # get new partial score
                 upper_bound += partial_score
-                heappush(query_info_list, (-partial_score, xi, r, pos))
+                heappush(query_info_list, (-partial_score, xi, pos, end))
+            if trace is not None:
+                trace.step(n_sorted_accesses, upper_bound, top_list[0][0])
+        top_list.sort()
+        if trace is not None:
+            trace.count_score(n=n_items_scored)
+            self._finish_trace(trace, n_sorted_accesses, n_items_scored)
+        t1 = time()
+        if count_calculations:
+            return top_list, n_items_scored, t1 - t0
+        else:
+            return top_list
+
+    def _wand_walk(self, x_u, K, use_block_max, engine):
+        """
+        Runs the compiled WAND walk for a query, returns the top list, the
+        number of items scored and of pivots
+        Features with a negative query element only lower the scores and
+        are not walked, but are part of the scores
+        """
+        trace = self._start_trace(engine)
+        x_dense, x_values, x_features = self.query_accumulator(x_u)
+        walked = (x_values > 0) & (self.postings_ptr[x_features + 1] >
+                    self.postings_ptr[x_features])
+        x_values, x_features = x_values[walked], x_features[walked]
+        values = np.ones(K) * -1e10
+        items = -np.ones(K, dtype=np.int64)
+        n_items_scored, n_pivots = wand_engine(x_dense, x_values,
+                    x_values * self.feature_max[x_features],
+                    self.blocks_ptr[x_features], self.blocks_ptr[x_features + 1],
+                    self.block_starts, self.block_last, self.block_max,
+                    self.doc_rows, self.doc_values, self.packed_rows,
+                    self.block_offsets, self.block_bits, self.block_first,
+                    self.impacts, self.compressed, self.block_size,
+                    self.Y.indptr, self.Y.indices, self.Y.data, values, items,
+                    use_block_max)
+        top_list = [(val, ind) if ind >= 0 else (val, )
+                    for val, ind in zip(values, items)]
         top_list.sort()
+        if trace is not None:
+            trace.time_access = False  # not visible from Python
+            trace.count_score(n=n_items_scored)
+            self._finish_trace(trace, n_pivots, n_items_scored)
+        return top_list, n_items_scored, n_pivots
+
+    def get_top_K_wand(self, x_u, K=1, count_calculations=False):
+        """
+        Returns top-K using WAND, suited for very sparse data with many
+        features
+        """
+        t0 = time()
+        top_list, n_items_scored, n_pivots = self._wand_walk(x_u, K, False,
+                    'sparse_wand')
+        t1 = time()
+        if count_calculations:
+            return top_list, n_items_scored, t1 - t0
+        else:
+            return top_list
+
+    def get_top_K_block_max_wand(self, x_u, K=1, count_calculations=False):
+        """
+        Returns top-K using Block-Max WAND: as WAND, but the maxima of the
+        blocks of the postings allow skipping whole blocks
+        """
+        t0 = time()
+        top_list, n_items_scored, n_pivots = self._wand_walk(x_u, K, True,
+                    'sparse_bmw')
         t1 = time()
         if count_calculations:
             return top_list, n_items_scored, t1 - t0
         else:
             return top_list
 
+    def _run_queries(self, queries, K, algorithm):
+        if algorithm not in ('wand', 'bmw'):
+            return TopKInference._run_queries(self, queries, K, algorithm)
+        get_top_K = self.get_top_K_wand if algorithm == 'wand' else \
+                    self.get_top_K_block_max_wand
+        n_scores_calc = []
+        runtimes = []
+        top_Ks = []
+        for x_u in queries:
+            top_list, n_items_scored, runtime = get_top_K(x_u, K,
+                        count_calculations=True)
+            top_Ks.append(top_list)
+            runtimes.append(runtime)
+            n_scores_calc.append(n_items_scored)
+        return top_Ks, n_scores_calc, runtimes
+
 if __name__ == '__main__':
 
     import numpy as np
@@ -510,6 +1958,32 @@ if __name__ == '__main__':
     print 'Partial threshold: %s calculations in %s seconds' %(n_scored_partial, runtime_partial)
     print
 
+    queries = np.random.randn(100, R)**2
+
+    top_Ks_batch, n_scored_batch, runtimes_batch = inferer.get_top_K(queries, K,
+                algorithm='batch', profile=True)
+
+    print 'Batched threshold for %s queries: %s calculations in %s seconds per query' %(
+                len(queries), np.mean(n_scored_batch), np.mean(runtimes_batch))
+    print
+
+    t0 = time()
+    top_values_all, top_items_all = top_k_all(queries, W, K)
+    t1 = time()
+
+    print 'All queries at once: %s seconds per query' %((t1 - t0) / len(queries))
+    print
+
+    # heavy-tailed norms, pruned by the norm buckets
+    W_norms = np.random.randn(n, R) * (np.random.pareto(2.0, n) + 1)[:, None]
+    norm_inferer = TopKInference(W_norms, initialize_lists=True, bucket_size=256)
+    x = np.random.randn(R)
+
+    top_5_list_norm, n_scored_norm, runtime_norm = norm_inferer.get_top_K_norm(x, K, True)
+
+    print 'Norm buckets: %s calculations in %s seconds' %(n_scored_norm, runtime_norm)
+    print
+
     # TESTING THE SPARSE FRAMEWORK
     # ----------------------------
 
@@ -533,9 +2007,13 @@ if __name__ == '__main__':
 
     top_5_list_thr_enh, n_scored_thr_enh, runtime_thr_enh = sparse_inferer.get_top_K_threshold_enhanced(x_u, K, True)
 
+    sparse_inferer.get_top_K_block_max_wand(x_u, K)  # compile
+    top_5_list_bmw, n_scored_bmw, runtime_bmw = sparse_inferer.get_top_K_block_max_wand(x_u, K, True)
+
 
     print 'Tested for SPARSE data of size %s with R of %s' %(n, R)
     print 'Naive: %s calculations in %s seconds' %(n_scored_naive, runtime_naive)
     print 'Threshold: %s calculations in %s seconds' %(n_scored_threshold, runtime_thr)
     print 'Enhanced threshold: %s calculations in %s seconds' %(n_scored_thr_enh, runtime_thr_enh)
+    print 'Block-Max WAND: %s calculations in %s seconds' %(n_scored_bmw, runtime_bmw)
     print
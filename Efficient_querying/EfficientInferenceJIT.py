@@ -9,8 +9,12 @@ Implementation of algorithms for the efficient inference of the top-K of
 seperable linear models, made to be compatible with JIT
 """
 
-from heaps import MaxHeap, MinHeap
+import numpy as np
+from heaps import MaxHeap, MinHeap, min_heap_update
+from visited import VisitedStamps
 from numba import jit
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 from time import time
 
 @jit
@@ -51,7 +55,7 @@ def get_top_naive(x, Y, topheap):
     return topheap, n_calculations
 
 #@jit
-def get_top_threshold(x, Y, topheap, sorted_lists, is_scored):
+def get_top_threshold(x, Y, topheap, sorted_lists, is_scored, epoch=1):
     M, R = Y.shape
     n_calculations = 0
     upper_bound = np.inf
@@ -65,18 +69,19 @@ def get_top_threshold(x, Y, topheap, sorted_lists, is_scored):
                 item = sorted_lists[pos, r]
             else:
                 item = sorted_lists[M - 1 - pos, r]
-            if not is_scored[item]:
+            if is_scored[item] != epoch:
                 score = score_item(x, Y, item)
                 topheap.heapupdate(score)
                 n_calculations += R
-                is_scored[item] = 1
+                is_scored[item] = epoch
                 lower_bound = topheap.peek()[0]
             upper_bound += x[r] * Y[item, r]
         pos += 1
     return topheap, n_calculations
 
 #@jit
-def get_top_threshold_partial(x, Y, topheap, sorted_lists, is_scored, partial_scores):
+def get_top_threshold_partial(x, Y, topheap, sorted_lists, is_scored, partial_scores,
+            epoch=1):
     M, R = Y.shape
     pos = 0
     for r in range(R):
@@ -97,54 +102,355 @@ def get_top_threshold_partial(x, Y, topheap, sorted_lists, is_scored, partial_sc
             upper_bound -= partial_scores[r]
             partial_scores[r] = pr
             upper_bound += pr
-            if not is_scored[item]:
+            if is_scored[item] != epoch:
                 is_compl, n_calc, score = partial_score_item(x, Y, item,
                     partial_scores, upper_bound, lower_bound, R)
                 if is_compl:
                     topheap.heapupdate(score)
                 n_calculations += n_calc
-                is_scored[item] = 1
+                is_scored[item] = epoch
                 lower_bound = topheap.peek()[0]
         pos += 1
     return topheap, n_calculations
 
+# Compiled engine
+# ---------------
+# the functions above are kept as a reference implementation, the functions
+# below run the whole query in nopython mode, using only arrays, and release
+# the GIL so that queries can run in parallel threads
+
+NAIVE = 0
+THRESHOLD = 1
+PARTIAL_THRESHOLD = 2
+
+def algorithm_code(algorithm):
+    """
+    Returns the code of the compiled engine for the name of an algorithm
+    """
+    if algorithm == 'partial_threshold':
+        return PARTIAL_THRESHOLD
+    elif algorithm == 'threshold':
+        return THRESHOLD
+    elif algorithm == 'naive':
+        return NAIVE
+    else:
+        print 'Unknown algorithm selected...'
+        raise KeyError
+
+@jit(nopython=True, nogil=True)
+def naive_engine(x, Y, values, indices):
+    """
+    Scores all items, keeps the top in the min heap (values, indices)
+    """
+    M, R = Y.shape
+    lower_bound = values[0]
+    for item in range(M):
+        score = 0.0
+        for r in range(R):
+            score += x[r] * Y[item, r]
+        if score > lower_bound:
+            lower_bound = min_heap_update(values, indices, score, item)
+    return M * R
+
+@jit(nopython=True, nogil=True)
+def scan_engine(X, Y, start, end, values, indices):
+    """
+    Scores the items start:end for every query (row) in X, keeps the top of
+    query q in the min heap (values[q], indices[q])
+    Every item is read once for all queries, the scores are accumulated in
+    double precision also when Y is float32
+    """
+    R = Y.shape[1]
+    n_queries = X.shape[0]
+    values[:] = -np.inf
+    indices[:] = -1
+    for item in range(start, end):
+        for q in range(n_queries):
+            score = 0.0
+            for r in range(R):
+                score += X[q, r] * Y[item, r]
+            if score > values[q, 0]:
+                min_heap_update(values[q], indices[q], score, item)
+    return (end - start) * R
+
+@jit(nopython=True, nogil=True)
+def threshold_engine(x, Y, sorted_lists, values, indices, stamps, epoch):
+    """
+    Threshold algorithm, keeps the top in the min heap (values, indices)
+    sorted_lists are sorted in decreasing order, an item is scored when its
+    stamp equals epoch
+    """
+    M, R = Y.shape
+    n_calculations = 0
+    upper_bound = np.inf
+    lower_bound = values[0]
+    pos = 0
+    while upper_bound > lower_bound and pos < M:
+        upper_bound = 0.0
+        for r in range(R):
+            if x[r] >= 0:
+                item = sorted_lists[pos, r]
+            else:
+                item = sorted_lists[M - 1 - pos, r]
+            if stamps[item] != epoch:
+                score = 0.0
+                for s in range(R):
+                    score += x[s] * Y[item, s]
+                if score > lower_bound:
+                    lower_bound = min_heap_update(values, indices, score, item)
+                n_calculations += R
+                stamps[item] = epoch
+            upper_bound += x[r] * Y[item, r]
+        pos += 1
+    return n_calculations
+
+@jit(nopython=True, nogil=True)
+def threshold_partial_engine(x, Y, sorted_lists, values, indices, stamps,
+            epoch, partial_scores):
+    """
+    Threshold algorithm where the items are only scored as long as they can
+    improve upon the lower bound
+    sorted_lists are sorted in decreasing order
+    """
+    M, R = Y.shape
+    n_calculations = 0
+    upper_bound = 0.0
+    for r in range(R):
+        if x[r] >= 0:
+            item = sorted_lists[0, r]
+        else:
+            item = sorted_lists[M - 1, r]
+        partial_scores[r] = x[r] * Y[item, r]
+        upper_bound += partial_scores[r]
+    lower_bound = values[0]
+    pos = 0
+    while upper_bound > lower_bound and pos < M:
+        for r in range(R):
+            if x[r] >= 0:
+                item = sorted_lists[pos, r]
+            else:
+                item = sorted_lists[M - 1 - pos, r]
+            pr = x[r] * Y[item, r]
+            upper_bound += pr - partial_scores[r]
+            partial_scores[r] = pr
+            if stamps[item] != epoch:
+                # score until it can no longer improve upon the lower bound
+                score = upper_bound
+                s = 0
+                while score > lower_bound and s < R:
+                    score += x[s] * Y[item, s] - partial_scores[s]
+                    s += 1
+                if s == R and score > lower_bound:
+                    lower_bound = min_heap_update(values, indices, score, item)
+                n_calculations += s
+                stamps[item] = epoch
+        pos += 1
+    return n_calculations
+
+@jit(nopython=True, nogil=True)
+def query_kernel(x, Y, sorted_lists, values, indices, stamps, epoch,
+            partial_scores, algorithm):
+    """
+    Runs a single query with the given scratch buffers, which are reset here
+    except for the visited stamps: epoch must be new for these stamps
+    The top ends up in (values, indices) as a min heap
+    """
+    values[:] = -np.inf
+    indices[:] = -1
+    if algorithm == NAIVE:
+        return naive_engine(x, Y, values, indices)
+    if algorithm == THRESHOLD:
+        return threshold_engine(x, Y, sorted_lists, values, indices,
+                    stamps, epoch)
+    else:
+        return threshold_partial_engine(x, Y, sorted_lists, values, indices,
+                    stamps, epoch, partial_scores)
+
+@jit(nopython=True, nogil=True)
+def query_engine(X, Y, sorted_lists, K, algorithm, stamps, first_epoch):
+    """
+    Returns the top-K for every query (row) in X as a (values, indices) pair
+    of arrays, sorted in increasing order, and the number of calculations
+    for each query
+    Query q uses the visited stamps with epoch first_epoch + q
+    """
+    M, R = Y.shape
+    n_queries = X.shape[0]
+    top_values = np.empty((n_queries, K))
+    top_indices = np.empty((n_queries, K), dtype=np.int64)
+    n_calculations = np.zeros(n_queries, dtype=np.int64)
+    values = np.empty(K)
+    indices = np.empty(K, dtype=np.int64)
+    partial_scores = np.zeros(R)
+    for q in range(n_queries):
+        n_calculations[q] = query_kernel(X[q], Y, sorted_lists, values,
+                    indices, stamps, first_epoch + q, partial_scores,
+                    algorithm)
+        order = np.argsort(values)
+        top_values[q] = values[order]
+        top_indices[q] = indices[order]
+    return top_values, top_indices, n_calculations
+
 class TopKInference():
     """
     A module collecting different algorithms to find the top-K for a given
     query and SEP-LR model.
     This class is designed for dense matrices
+
+    With rotate=True, the items and the queries are rotated to the
+    eigenbasis V of Y.T Y (or to the orthogonal basis given as basis) before
+    the sorted lists are built. This concentrates the energy in the leading
+    coordinates so that the upper bound drops faster, while the inner
+    products, and hence the results, do not change.
     """
-    def __init__(self, Y, initialize_lists=True):
-        self.V = np.linalg.eigh(Y.T.dot(Y))[1]  # calculate eigenvectors
-        self.Y = Y
+    def __init__(self, Y, initialize_lists=True, rotate=False, basis=None):
         self.M, self.R = Y.shape
+        self.V = None
+        if basis is not None:
+            self.V = basis
+        elif rotate:
+            eigenvalues, V = np.linalg.eigh(Y.T.dot(Y))  # calculate eigenvectors
+            self.V = V[:, ::-1]  # decreasing eigenvalues
+        if self.V is not None:
+            self.Y = np.ascontiguousarray(Y.dot(self.V))
+        else:
+            self.Y = Y
+        self.instrumentation = None
+        self.visited = VisitedStamps(self.M)
+        self.scan_pool = None
+        self.n_scan_threads = None
         if initialize_lists:
             self.initialize_sorted_lists()
 
+    def set_instrumentation(self, instrumentation):
+        """
+        Reports per-query measurements to an Instrumentation, None turns the
+        instrumentation off
+        The compiled engine only reports the number of items scored
+        """
+        self.instrumentation = instrumentation
+
+    def rotate_queries(self, queries):
+        """
+        Expresses the queries in the basis of the index
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=float))
+        if self.V is not None:
+            queries = queries.dot(self.V)
+        return queries
+
+    def rotation_report(self, queries, K=1, algorithm='threshold'):
+        """
+        Returns the number of calculations per query with and without the
+        rotation of the index (the latter needs sorting the original items)
+        """
+        n_calc_rotated = self.get_top_K_compiled(queries, K, algorithm)[2]
+        if self.V is None:
+            return n_calc_rotated, n_calc_rotated
+        unrotated = TopKInference(self.Y.dot(self.V.T))
+        n_calc_unrotated = unrotated.get_top_K_compiled(queries, K,
+                    algorithm)[2]
+        return n_calc_rotated, n_calc_unrotated
+
     def initialize_sorted_lists(self):
         """
         Initializes the sorted lists
         """
         self.sorted_lists = (-self.Y).argsort(0)
 
-    def get_top_K(self, queries, K=1, algorithm='threshold', profile=False):
+    def get_top_K_compiled(self, queries, K=1, algorithm='threshold'):
+        """
+        Returns the top-K for all queries using the compiled engine, as arrays
+        of values and indices (sorted in increasing order) and the number of
+        calculations per query
+        """
+        queries = self.rotate_queries(queries)
+        first_epoch = self.visited.new_epochs(len(queries))
+        results = query_engine(queries, self.Y, self.sorted_lists, K,
+                    algorithm_code(algorithm), self.visited.stamps, first_epoch)
+        if self.instrumentation is not None:
+            for n_calc in results[2]:
+                trace = self.instrumentation.start('jit_' + algorithm)
+                if trace is not None:
+                    trace.time_access = False  # not visible from Python
+                    trace.count_score(n=n_calc / float(self.R))
+                    self.instrumentation.finish(trace, None,
+                                n_calc / float(self.R))
+        return results
+
+    def get_top_K_scan(self, queries, K=1, n_threads=None):
+        """
+        Returns the top-K for all queries by scoring all items, as
+        get_top_K_compiled: the items are split in one range per thread,
+        every thread keeps its own heaps and these are merged at the end
+        """
+        queries = self.rotate_queries(queries)
+        if n_threads is None:
+            n_threads = cpu_count()
+        if n_threads != self.n_scan_threads:
+            if self.scan_pool is not None:
+                self.scan_pool.close()
+            self.scan_pool = ThreadPool(n_threads)
+            self.n_scan_threads = n_threads
+        n_queries = len(queries)
+        bounds = np.linspace(0, self.M, n_threads + 1).astype(int)
+        values = np.empty((n_threads, n_queries, K))
+        indices = np.empty((n_threads, n_queries, K), dtype=np.int64)
+        self.scan_pool.map(lambda t: scan_engine(queries, self.Y, bounds[t],
+                    bounds[t+1], values[t], indices[t]), range(n_threads))
+        # the K best of the n_threads heaps of every query
+        values = values.transpose(1, 0, 2).reshape(n_queries, -1)
+        indices = indices.transpose(1, 0, 2).reshape(n_queries, -1)
+        order = np.argsort(values, axis=1)[:, -K:]
+        n_calculations = np.ones(n_queries, dtype=np.int64) * self.M * self.R
+        if self.instrumentation is not None:
+            for n_calc in n_calculations:
+                trace = self.instrumentation.start('jit_scan')
+                if trace is not None:
+                    trace.time_access = False
+                    trace.count_score(n=self.M)
+                    self.instrumentation.finish(trace, None, self.M)
+        return np.take_along_axis(values, order, axis=1), \
+                    np.take_along_axis(indices, order, axis=1), n_calculations
+
+    def get_top_K(self, queries, K=1, algorithm='threshold', profile=False,
+                reference=False):
         """
         Returns the top-K objects for a given query
+        Uses the compiled engine, unless reference is True
         """
+        if not reference:
+            top_Ks = []
+            n_calculations = []
+            runtimes = []
+            for x_u in queries:
+                t1 = time()
+                values, indices, n_calc = self.get_top_K_compiled([x_u], K,
+                            algorithm)
+                t2 = time()
+                top_Ks.append(zip(values[0], indices[0]))
+                if profile:
+                    runtimes.append(t2 - t1)
+                    n_calculations.append(n_calc[0])
+            if not profile:
+                return top_Ks
+            else:
+                return top_Ks, n_calculations, runtimes
         n_calculations = []
         runtimes = []
         top_Ks = []
         partial_scores = np.zeros(self.R)
-        for x_u in queries:
+        for x_u in self.rotate_queries(queries):
             topheap = MinHeap(-np.ones(K)*np.inf, np.arange(K))
-            is_scored = np.zeros(self.M, dtype=int)
+            epoch = self.visited.new_epoch()
             t1 = time()
             if algorithm == 'partial_threshold':
                 top_list, n_calc = get_top_threshold_partial(x_u, self.Y, topheap,
-                        self.sorted_lists, is_scored, partial_scores)
+                        self.sorted_lists, self.visited.stamps, partial_scores,
+                        epoch)
             elif algorithm == 'threshold':
                 top_list, n_calc = get_top_threshold(x_u, self.Y, topheap,
-                        self.sorted_lists, is_scored)
+                        self.sorted_lists, self.visited.stamps, epoch)
             elif algorithm == 'naive':
                 top_list, n_calc =  get_top_naive(x_u, self.Y, topheap)
             else:
@@ -207,3 +513,27 @@ if __name__ == '__main__':
     print 'Threshold: %s calculations in %s seconds' %(np.mean(n_calc_thr), np.mean(runtimes_thr))
     print 'Partial threshold: %s calculations in %s seconds' %(np.mean(n_calc_partial), np.mean(runtimes_partial))
     print
+
+    # TESTING THE PARALLEL SCAN
+    # -------------------------
+
+    inferer.get_top_K_scan(queries[:1], K=5)  # compile
+    t1 = time()
+    values_scan, indices_scan, n_calc_scan = inferer.get_top_K_scan(queries, K=5)
+    t2 = time()
+    print 'Parallel scan: %s seconds per query, same scores as naive: %s' %(
+                (t2 - t1) / len(queries), np.allclose(values_scan,
+                [[val for val, ind in top_list] for top_list in top_K_naive]))
+    print
+
+    # TESTING THE ROTATION
+    # --------------------
+
+    # correlated items
+    Y_corr = np.random.randn(n, R).dot(np.random.randn(R, R))
+    rotated_inferer = TopKInference(Y_corr, rotate=True)
+    n_calc_rot, n_calc_orig = rotated_inferer.rotation_report(queries, K=5)
+
+    print 'Correlated data, threshold: %s calculations, %s after rotation' %(
+                np.mean(n_calc_orig), np.mean(n_calc_rot))
+    print
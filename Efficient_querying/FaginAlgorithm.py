@@ -21,8 +21,7 @@ class FaginAlgorithmSparse:
         '''
         self.Y = Y.tocsr()
         self.Ni, self.K = Y.shape
-        self.steps_taken = [] #number of steps the algororithm takes for one query
-        self.calculated = [] #number of scores for one query
+        self.instrumentation = None #reports the steps and scores of a query
         if init:
             self.init_sorted_lists()
                 
@@ -46,6 +45,13 @@ class FaginAlgorithmSparse:
             N: number of top items to find
         '''
         return [self.bestN(x_u, N) for x_u in X]
+
+    def set_instrumentation(self, instrumentation):
+        '''
+        Reports the number of steps and of scores of every query to an
+        Instrumentation, None turns it off
+        '''
+        self.instrumentation = instrumentation
         
     def repairL(self, stepsBack, reversedks):
         '''
@@ -109,8 +115,11 @@ class FaginAlgorithmSparse:
                 S_values[replace_index] = (S, it)
                 lowerS = min(S_values)[0]
             n_items += 1
-        self.steps_taken.append(steps)
-        self.calculated.append(n_items)
+        if self.instrumentation is not None:
+            trace = self.instrumentation.start('legacy_fagin_sparse')
+            if trace is not None:
+                trace.count_score(n=n_items)
+                self.instrumentation.finish(trace, steps, n_items)
         return S_values
 
 
@@ -124,8 +133,7 @@ class FaginAlgorithm:
         self.Y = Y
         self.Ni = len(Y)
         self.K = len(Y[0])
-        self.steps_taken = [] #number of steps the algororithm takes for one query
-        self.calculated = [] #number of scores for one query
+        self.instrumentation = None #reports the steps and scores of a query
         if init:
             self.init_sorted_lists()
             
@@ -148,6 +156,13 @@ class FaginAlgorithm:
             N: number of top items to find
         '''
         return [self.bestN(x_u, N) for x_u in X]
+
+    def set_instrumentation(self, instrumentation):
+        '''
+        Reports the number of steps and of scores of every query to an
+        Instrumentation, None turns it off
+        '''
+        self.instrumentation = instrumentation
         
     def repairL(self, stepsBack, reversedks):
         '''
@@ -198,8 +213,11 @@ class FaginAlgorithm:
                 replace_index = S_values.index(min(S_values))
                 S_values[replace_index] = (S, it)
                 lowerS = min(S_values)[0]
-        self.steps_taken.append(steps)
-        self.calculated.append(len(unionset))
+        if self.instrumentation is not None:
+            trace = self.instrumentation.start('legacy_fagin')
+            if trace is not None:
+                trace.count_score(n=len(unionset))
+                self.instrumentation.finish(trace, steps, len(unionset))
         self.repairL( steps, reversed)
         return S_values
        
@@ -213,6 +231,7 @@ if __name__=="__main__":
     import random as rd
     import numpy as np
     from sklearn.preprocessing import normalize
+    from instrumentation import Instrumentation, MemorySink
     
     rd.seed(99)
     
@@ -232,6 +251,8 @@ if __name__=="__main__":
 	    
 	    
 	    TA = FaginAlgorithm(Y)
+	    sink = MemorySink(nx)
+	    TA.set_instrumentation(Instrumentation(sink))
 	    
 	    
 	    TA.init_sorted_lists()
@@ -258,7 +279,7 @@ if __name__=="__main__":
 	    print 'Time to multiply in naive algorithm', Exact_Mult_Time - Fagin_Sort_Time
 	    print 'Time to run naive algorithm', Exact_Sort_Time - Exact_Mult_Time
 	    
-	    print 'Average number of steps in Fagin', np.mean(TA.steps_taken)
+	    print 'Average number of steps in Fagin', np.mean([record['depth'] for record in sink.records])
 	    
     if testSparse:
         density = 0.001
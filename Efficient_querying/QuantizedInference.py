@@ -0,0 +1,253 @@
+"""
+Created on Sun Oct 18 2026
+Last update: -
+
+Two-stage top-K with a quantized copy of the items: the quantized items are
+scored to generate c * K candidates, which are re-ranked exactly with the
+full-precision items. Two quantizers are available:
+    - 'pq': product quantization, every group of features is encoded as one
+        of 256 centroids (one byte), scored with a lookup table per group
+    - 'int8': scalar quantization of every value to a byte, with a scale
+        per feature
+The result is approximate: recall_at_K measures the recall against the
+naive engine for several values of c.
+"""
+
+import numpy as np
+from time import time
+from EfficientInference import TopKInference, merge_top_K
+
+# rows scored at once, bounds the memory of the int8 scoring
+CHUNK_SIZE = 65536
+
+def train_kmeans(X, k, n_iter=10, seed=None):
+    """
+    Returns k centroids for the rows of X (Lloyd's algorithm)
+    """
+    random_state = np.random.RandomState(seed)
+    k = min(k, X.shape[0])
+    centroids = X[random_state.choice(X.shape[0], k, replace=False)].copy()
+    for iteration in range(n_iter):
+        assignment = assign_centroids(X, centroids)
+        counts = np.bincount(assignment, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, X)
+        non_empty = counts > 0  # empty clusters keep their centroid
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+    return centroids
+
+def assign_centroids(X, centroids):
+    """
+    Index of the closest centroid for every row of X
+    """
+    distances = (centroids**2).sum(1) - 2 * X.dot(centroids.T)
+    return distances.argmin(1)
+
+def train_product_quantizer(Y, n_subspaces, n_centroids=256, n_train=20000,
+            seed=None):
+    """
+    Splits the features in n_subspaces groups and learns the centroids of
+    every group on a sample of n_train items, returns (features, centroids)
+    for every group
+    """
+    random_state = np.random.RandomState(seed)
+    M, R = Y.shape
+    sample = Y[np.sort(random_state.choice(M, min(M, n_train),
+                replace=False))]
+    return [(features, train_kmeans(sample[:, features], n_centroids,
+                seed=random_state.randint(2**31)))
+            for features in np.array_split(np.arange(R), n_subspaces)]
+
+def encode_product_quantizer(Y, quantizer):
+    """
+    Codes (one byte per group) of all items
+    """
+    codes = np.empty((Y.shape[0], len(quantizer)), dtype=np.uint8)
+    for start in range(0, Y.shape[0], CHUNK_SIZE):
+        block = np.asarray(Y[start:start+CHUNK_SIZE])
+        for j, (features, centroids) in enumerate(quantizer):
+            codes[start:start+CHUNK_SIZE, j] = assign_centroids(
+                        block[:, features], centroids)
+    return codes
+
+class QuantizedInference(TopKInference):
+    """
+    Top-K by scoring a quantized copy of Y and re-ranking the c * K best
+    candidates with Y
+    Supports the methods of TopKInference and adds get_top_K_quantized, also
+    available as algorithm 'quantized' in get_top_K
+    """
+    def __init__(self, Y, initialize_lists=False, quantizer='pq',
+                n_subspaces=None, c=10, seed=None):
+        TopKInference.__init__(self, Y, initialize_lists)
+        self.quantizer = quantizer
+        if n_subspaces is None:
+            n_subspaces = max(1, self.R // 2)
+        self.n_subspaces = n_subspaces
+        self.c = c
+        self.initialize_quantizer(seed)
+
+    def initialize_quantizer(self, seed=None):
+        """
+        Learns the quantizer and encodes the items
+        """
+        if self.quantizer == 'pq':
+            self.codebooks = train_product_quantizer(self.Y, self.n_subspaces,
+                        seed=seed)
+        elif self.quantizer == 'int8':
+            scales = np.abs(self.Y).max(0) / 127.0
+            scales[scales == 0] = 1.0
+            self.scales = scales
+        else:
+            raise ValueError('Unknown quantizer %s' %self.quantizer)
+        self.codes = self.encode(self.Y)
+
+    def encode(self, Y):
+        """
+        Quantized codes of the rows of Y
+        """
+        if self.quantizer == 'pq':
+            return encode_product_quantizer(Y, self.codebooks)
+        codes = np.empty(Y.shape, dtype=np.int8)
+        for start in range(0, Y.shape[0], CHUNK_SIZE):
+            # values beyond the training range are clipped
+            codes[start:start+CHUNK_SIZE] = np.clip(np.round(
+                        Y[start:start+CHUNK_SIZE] / self.scales), -127, 127)
+        return codes
+
+    def merge_delta(self):
+        """
+        Merges the delta buffer into the sorted lists (when initialized) and
+        encodes its items
+        """
+        items = np.array(self.delta_items, dtype=int)
+        TopKInference.merge_delta(self)
+        if len(self.codes) < self.M:
+            self.codes = np.concatenate((self.codes, np.zeros((self.M -
+                        len(self.codes), self.codes.shape[1]),
+                        dtype=self.codes.dtype)))
+        if len(items) == 0:
+            return
+        if self.quantizer == 'int8' and \
+                    np.any(np.abs(self.Y[items]) > 127 * self.scales):
+            # values out of range, the merge rewrites the lists anyway
+            self.initialize_quantizer()
+        else:
+            self.codes[items] = self.encode(self.Y[items])
+
+    def approximate_scores(self, x_u):
+        """
+        Scores of all quantized items
+        """
+        if self.quantizer == 'pq':
+            scores = np.zeros(len(self.codes))
+            for j, (features, centroids) in enumerate(self.codebooks):
+                table = centroids.dot(x_u[features])  # lookup table
+                scores += table[self.codes[:, j]]
+            return scores
+        scaled_query = x_u * self.scales
+        return np.concatenate([self.codes[start:start+CHUNK_SIZE].dot(
+                    scaled_query) for start in range(0, len(self.codes),
+                    CHUNK_SIZE)])
+
+    def get_top_K_quantized(self, x_u, K=1, count_calculations=False, c=None):
+        """
+        Returns the (approximate) top-K: the c * K best items for the
+        quantized scores are re-ranked with their exact scores
+        """
+        t0 = time()
+        trace = self._start_trace('quantized')
+        if c is None:
+            c = self.c
+        x_u = np.asarray(x_u, dtype=float)
+        top_values = np.ones(K) * -1e10
+        top_items = -np.ones(K, dtype=int)
+        scores = self.approximate_scores(x_u)
+        # deleted items and the items of the delta buffer
+        scores[self.deleted[:len(scores)]] = -np.inf
+        skip = self._skipped()
+        if len(skip):
+            scores[skip[skip < len(scores)]] = -np.inf
+        n_candidates = min(c * K, len(scores))
+        candidates = np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+        candidates = candidates[np.isfinite(scores[candidates])]
+        exact_scores = self.Y[candidates].dot(x_u)
+        top_values, top_items = merge_top_K(top_values, top_items,
+                    exact_scores, candidates, K)
+        n_items_scored = len(candidates)
+        if len(self.delta_items):
+            delta_scores, delta = self._score_delta(x_u)
+            top_values, top_items = merge_top_K(top_values, top_items,
+                        delta_scores, delta, K)
+            n_items_scored += len(delta)
+        top_list = [(val, ind) if ind >= 0 else (val, )
+                    for val, ind in zip(top_values, top_items)]
+        top_list.sort()
+        if trace is not None:
+            trace.count_score(n=n_items_scored)
+            self._finish_trace(trace, None, n_items_scored)
+        t1 = time()
+        if count_calculations:
+            return top_list, n_items_scored, t1 - t0
+        else:
+            return top_list
+
+    def recall_at_K(self, queries, K=1, cs=(1, 2, 5, 10, 20)):
+        """
+        Returns for every c the mean fraction of the top-K items of the naive
+        engine that are found by get_top_K_quantized
+        """
+        truth = [set([item[1] for item in self.get_top_K_naive(x_u, K)
+                    if len(item) == 2]) for x_u in queries]
+        recalls = {}
+        for c in cs:
+            found = [set([item[1] for item in self.get_top_K_quantized(x_u,
+                        K, c=c) if len(item) == 2]) for x_u in queries]
+            recalls[c] = np.mean([len(true_items & found_items) /
+                        float(max(len(true_items), 1))
+                        for true_items, found_items in zip(truth, found)])
+        return recalls
+
+    def quantized_nbytes(self):
+        """
+        Memory of the quantized items (codes and codebooks or scales)
+        """
+        if self.quantizer == 'pq':
+            return self.codes.nbytes + sum([centroids.nbytes
+                        for features, centroids in self.codebooks])
+        return self.codes.nbytes + self.scales.nbytes
+
+    def _run_queries(self, queries, K, algorithm):
+        if algorithm != 'quantized':
+            return TopKInference._run_queries(self, queries, K, algorithm)
+        n_scores_calc = []
+        runtimes = []
+        top_Ks = []
+        for x_u in queries:
+            top_list, n_items_scored, runtime = self.get_top_K_quantized(x_u,
+                        K, count_calculations=True)
+            top_Ks.append(top_list)
+            runtimes.append(runtime)
+            n_scores_calc.append(n_items_scored)
+        return top_Ks, n_scores_calc, runtimes
+
+if __name__ == '__main__':
+
+    R = 32
+    n = 100000
+    K = 10
+
+    Y = np.random.randn(n, R).dot(np.random.randn(R, R))
+    queries = np.random.randn(20, R)
+
+    for quantizer in ['pq', 'int8']:
+        inferer = QuantizedInference(Y, quantizer=quantizer, seed=1)
+        top_Ks, n_scored, runtimes = inferer.get_top_K(queries, K,
+                    algorithm='quantized', profile=True)
+        print 'Quantizer %s: %s bytes instead of %s' %(quantizer,
+                    inferer.quantized_nbytes(), Y.nbytes)
+        print '%s calculations in %s seconds' %(np.mean(n_scored),
+                    np.mean(runtimes))
+        print 'Recall@%s for c in (1, 2, 5, 10, 20):' %K, \
+                    inferer.recall_at_K(queries[:5], K)
+        print
@@ -0,0 +1,353 @@
+"""
+Created on Sun Oct 18 2026
+Last update: -
+
+Serving front end for top-K queries with micro-batching: requests wait in a
+bounded queue, a collector thread groups them into batches (at most
+max_batch_size requests, waiting at most max_wait seconds after the first
+one) and a pool of workers answers every batch with one call to the engine
+per (K, algorithm), so that the Python overhead is shared by concurrent
+users. Every request gets a future with its own result. The collector only
+takes a new batch when a worker is free, so that a slow engine fills the
+queue and the server rejects (or blocks) new requests.
+The code base is Python 2, without asyncio, so the front end uses threads
+and a queue; a JSON-lines TCP server and a load generator allow testing it
+locally.
+"""
+
+import json
+import socket
+import SocketServer
+import threading
+import numpy as np
+from collections import deque
+from scipy import sparse
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty, Full
+from time import time
+
+class ServerBusy(Exception):
+    """
+    Raised when the queue of requests is full
+    """
+    pass
+
+class ServerClosed(Exception):
+    """
+    Raised for requests that are not answered because the server is closed
+    """
+    pass
+
+class QueryFuture():
+    """
+    Result of a request, available when the batch of the request is done
+    """
+    def __init__(self):
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """
+        Waits for the result, raises the exception of a failed request
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError('Request timed out')
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+class MicroBatchServer():
+    """
+    Answers top-K queries of an inferer (TopKInference or one of its
+    subclasses) in micro-batches
+    With n_workers > 1 batches run concurrently, the inferer must then be
+    thread-safe (e.g. no result cache)
+    """
+    def __init__(self, inferer, max_batch_size=64, max_wait=0.002,
+                max_queue=1024, n_workers=1):
+        self.inferer = inferer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = Queue(max_queue)
+        self.pool = ThreadPool(n_workers)
+        # batches in flight, at most one per worker
+        self._free_workers = threading.Semaphore(n_workers)
+        self._lock = threading.Lock()
+        self.n_requests = 0
+        self.n_rejected = 0
+        self.n_batches = 0
+        self.max_queue_depth = 0
+        self.batch_sizes = deque(maxlen=1000)  # of the last batches
+        self.latencies = deque(maxlen=1000)  # of the last requests
+        self._running = True
+        self._collector = threading.Thread(target=self._collect)
+        self._collector.daemon = True
+        self._collector.start()
+
+    def submit(self, x_u, K=1, algorithm='threshold', block=False,
+                timeout=None):
+        """
+        Queues a query, returns a QueryFuture with its top list
+        When the queue is full, raises ServerBusy, or waits up to timeout
+        seconds if block is True (backpressure)
+        """
+        if not self._running:
+            raise ServerClosed('Server is closed')
+        future = QueryFuture()
+        if not sparse.issparse(x_u):
+            x_u = np.asarray(x_u, dtype=float)
+        try:
+            self.requests.put((x_u, K, algorithm, future, time()), block,
+                        timeout)
+        except Full:
+            with self._lock:
+                self.n_rejected += 1
+            raise ServerBusy('Queue of %s requests is full'
+                        %self.requests.maxsize)
+        with self._lock:
+            self.n_requests += 1
+            self.max_queue_depth = max(self.max_queue_depth,
+                        self.requests.qsize())
+        return future
+
+    def get_top_K(self, x_u, K=1, algorithm='threshold', timeout=None):
+        """
+        Submits a query and waits for its top list
+        """
+        return self.submit(x_u, K, algorithm, block=True).result(timeout)
+
+    def _collect(self):
+        """
+        Groups the queued requests into batches for the workers
+        """
+        while self._running:
+            # the requests wait in the queue until a worker is free
+            self._free_workers.acquire()
+            try:
+                batch = [self.requests.get(True, 0.1)]
+            except Empty:
+                self._free_workers.release()
+                continue
+            deadline = time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time()
+                try:
+                    if remaining > 0:
+                        batch.append(self.requests.get(True, remaining))
+                    else:
+                        batch.append(self.requests.get(False))
+                except Empty:
+                    break
+            with self._lock:
+                self.n_batches += 1
+                self.batch_sizes.append(len(batch))
+            self.pool.apply_async(self._run_batch, (batch, ))
+
+    def _run_batch(self, batch):
+        """
+        Answers a batch, with one call to the inferer per (K, algorithm)
+        """
+        try:
+            self._answer_batch(batch)
+        finally:
+            self._free_workers.release()
+
+    def _shares_threshold_walk(self):
+        """
+        Whether the inferer has the dense sorted lists of the batched
+        threshold walk (e.g. not the sparse engine, or an engine built
+        without sorted lists)
+        """
+        return hasattr(self.inferer, 'get_top_K_threshold_batch') and \
+                    hasattr(self.inferer, 'Y_sorted')
+
+    def _answer_batch(self, batch):
+        groups = {}
+        for request in batch:
+            groups.setdefault((request[1], request[2]), []).append(request)
+        for (K, algorithm), requests in groups.items():
+            if algorithm == 'threshold' and len(requests) > 1 and \
+                        self._shares_threshold_walk():
+                algorithm = 'batch'  # same result, shared walk
+            try:
+                top_Ks = self.inferer.get_top_K([request[0]
+                            for request in requests], K, algorithm)
+            except Exception as exception:
+                for request in requests:
+                    request[3].set_exception(exception)
+                continue
+            now = time()
+            for request, top_list in zip(requests, top_Ks):
+                request[3].set_result(top_list)
+                self.latencies.append(now - request[4])
+
+    def metrics(self):
+        """
+        Queue depth, batch sizes and latencies of the server
+        """
+        with self._lock:
+            batch_sizes = list(self.batch_sizes)
+            latencies = list(self.latencies)
+            metrics = {'queue_depth' : self.requests.qsize(),
+                    'max_queue_depth' : self.max_queue_depth,
+                    'requests' : self.n_requests,
+                    'rejected' : self.n_rejected,
+                    'batches' : self.n_batches}
+        metrics['batch_size_mean'] = float(np.mean(batch_sizes)) \
+                    if len(batch_sizes) else None
+        metrics['batch_size_max'] = max(batch_sizes) if len(batch_sizes) \
+                    else None
+        metrics['latency_p50'] = float(np.percentile(latencies, 50)) \
+                    if len(latencies) else None
+        metrics['latency_p99'] = float(np.percentile(latencies, 99)) \
+                    if len(latencies) else None
+        return metrics
+
+    def close(self):
+        """
+        Stops the collector and the workers, the batches in flight are
+        answered and the requests still in the queue fail with ServerClosed
+        """
+        self._running = False
+        self._collector.join()
+        self.pool.close()
+        self.pool.join()
+        while True:
+            try:
+                request = self.requests.get(False)
+            except Empty:
+                break
+            request[3].set_exception(ServerClosed('Server is closed'))
+
+# Local stand-in for the web tier
+# -------------------------------
+# one JSON object per line: {"query": [...], "K": 5, "algorithm": "threshold"}
+# is answered with {"scores": [...], "items": [...]} or {"error": "..."}
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                top_list = self.server.batch_server.submit(request['query'],
+                            request.get('K', 1),
+                            request.get('algorithm', 'threshold')).result(
+                            self.server.request_timeout)
+                response = {'scores' : [float(item[0]) for item in top_list
+                            if len(item) == 2],
+                        'items' : [int(item[1]) for item in top_list
+                            if len(item) == 2]}
+            except ServerBusy:
+                response = {'error' : 'busy'}
+            except Exception as exception:
+                response = {'error' : str(exception)}
+            self.wfile.write(json.dumps(response) + '\n')
+
+class QuerySocketServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    TCP server (one thread per connection) in front of a MicroBatchServer
+    A request that is not answered within request_timeout seconds gets an
+    error
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, batch_server, address=('127.0.0.1', 0),
+                request_timeout=30.0):
+        SocketServer.TCPServer.__init__(self, address, _RequestHandler)
+        self.batch_server = batch_server
+        self.request_timeout = request_timeout
+
+    def start(self):
+        """
+        Serves in a background thread, returns the (host, port) address
+        """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self.server_address
+
+class QueryClient():
+    """
+    Client for a QuerySocketServer, one request at a time
+    """
+    def __init__(self, address):
+        self.connection = socket.create_connection(address)
+        self.reader = self.connection.makefile('r')
+
+    def query(self, x_u, K=1, algorithm='threshold'):
+        self.connection.sendall(json.dumps({'query' : list(map(float, x_u)),
+                    'K' : K, 'algorithm' : algorithm}) + '\n')
+        return json.loads(self.reader.readline())
+
+    def close(self):
+        self.reader.close()
+        self.connection.close()
+
+def load_generator(address, queries, n_clients=8, K=1,
+            algorithm='threshold'):
+    """
+    Sends the queries from n_clients concurrent clients, returns the
+    latencies of the requests, the number of errors and the throughput
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    def run_client(client_queries):
+        client = QueryClient(address)
+        for x_u in client_queries:
+            t0 = time()
+            response = client.query(x_u, K, algorithm)
+            with lock:
+                latencies.append(time() - t0)
+                if 'error' in response:
+                    errors[0] += 1
+        client.close()
+    threads = [threading.Thread(target=run_client,
+                args=(queries[i::n_clients], )) for i in range(n_clients)]
+    t0 = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    t1 = time()
+    return latencies, errors[0], len(queries) / (t1 - t0)
+
+if __name__ == '__main__':
+
+    from EfficientInference import TopKInference
+
+    R = 10
+    n = 50000
+    K = 5
+
+    Y = np.random.rand(n, R)
+    queries = np.random.rand(200, R)
+
+    inferer = TopKInference(Y, initialize_lists=True)
+
+    for max_batch_size in [1, 32]:
+        batch_server = MicroBatchServer(inferer, max_batch_size=max_batch_size)
+        socket_server = QuerySocketServer(batch_server)
+        address = socket_server.start()
+        latencies, n_errors, throughput = load_generator(address, queries,
+                    n_clients=16, K=K)
+        socket_server.shutdown()
+        socket_server.server_close()
+        batch_server.close()
+        print 'Micro-batches of at most %s: %s queries per second, p50 latency %s s' %(
+                    max_batch_size, throughput, np.percentile(latencies, 50))
+        print batch_server.metrics()
+        print
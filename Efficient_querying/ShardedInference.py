@@ -0,0 +1,153 @@
+"""
+Created on Sun Oct 18 2026
+Last update: -
+
+Sharded top-K inference: the items are split over several shards, each with
+its own sorted lists, which are queried in parallel by a pool of processes.
+The shards share their lower bounds during the search, so a shard stops as
+soon as it cannot improve upon the K-th best score found by any shard.
+"""
+
+import numpy as np
+from heapq import nlargest
+from multiprocessing import Pool, Value, cpu_count
+from time import time
+from EfficientInference import TopKInference
+
+# shards and shared lower bounds of all instances, inherited by the forked
+# worker processes
+_shards = {}
+_shared_bounds = {}
+
+def exchange_bound(shared_bound):
+    """
+    Returns a function that publishes the lower bound of a shard and returns
+    the best one of all shards of the instance with this shared bound
+    """
+    def exchange(lower_bound):
+        with shared_bound.get_lock():
+            if lower_bound > shared_bound.value:
+                shared_bound.value = lower_bound
+            return shared_bound.value
+    return exchange
+
+def _query_shard((key, shard_id, x_u, K)):
+    """
+    Returns the top-K of one shard, using the shared lower bound
+    """
+    offset, inferer = _shards[key][shard_id]
+    top_list, n_items_scored, runtime = inferer.get_top_K_threshold_block(x_u,
+                K, True, exchange_bound=exchange_bound(_shared_bounds[key]))
+    # translate to global indices
+    top_list = [(item[0], item[1] + offset) for item in top_list
+                if len(item) == 2]
+    return top_list, n_items_scored
+
+class ShardedTopKInference():
+    """
+    Splits the items of Y in n_shards shards of consecutive items and
+    queries them with a pool of n_processes processes
+    """
+    def __init__(self, Y, n_shards=None, n_processes=None):
+        if n_processes is None:
+            n_processes = cpu_count()
+        if n_shards is None:
+            n_shards = n_processes
+        self.Y = Y
+        self.M, self.R = Y.shape
+        self.n_shards = n_shards
+        offsets = np.linspace(0, self.M, n_shards + 1).astype(int)
+        self.shards = []
+        for start, stop in zip(offsets[:-1], offsets[1:]):
+            inferer = TopKInference(Y[start:stop], initialize_lists=True)
+            self.shards.append((start, inferer))
+        self.shared_bound = Value('d', -1e10)
+        # shards have to be registered before the workers are forked
+        self._key = id(self)
+        _shards[self._key] = self.shards
+        _shared_bounds[self._key] = self.shared_bound
+        if n_processes > 1:
+            self.pool = Pool(n_processes)
+        else:
+            self.pool = None
+
+    def close(self):
+        """
+        Stops the worker processes
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        _shards.pop(self._key, None)
+        _shared_bounds.pop(self._key, None)
+
+    def get_top_K_sharded(self, x_u, K=1, count_calculations=False):
+        """
+        Returns the exact top-K by querying all shards and merging their top
+        lists
+        """
+        t0 = time()
+        self.shared_bound.value = -1e10
+        tasks = [(self._key, shard_id, x_u, K)
+                    for shard_id in range(self.n_shards)]
+        if self.pool is not None:
+            results = self.pool.map(_query_shard, tasks)
+        else:
+            results = map(_query_shard, tasks)
+        candidates = [item for top_list, n in results for item in top_list]
+        top_list = nlargest(K, candidates)
+        top_list += [(-1e10, )] * (K - len(top_list))
+        top_list.sort()
+        n_items_scored = sum([n for top_list_shard, n in results])
+        t1 = time()
+        if count_calculations:
+            return top_list, n_items_scored, t1 - t0
+        else:
+            return top_list
+
+    def get_top_K(self, queries, K=1, profile=False):
+        """
+        Returns the top-K objects for the given queries
+        """
+        n_scores_calc = []
+        runtimes = []
+        top_Ks = []
+        for x_u in queries:
+            top_list, n_items_scored, runtime = self.get_top_K_sharded(x_u,
+                        K, count_calculations=True)
+            top_Ks.append(top_list)
+            if profile:
+                runtimes.append(runtime)
+                n_scores_calc.append(n_items_scored)
+        if not profile:
+            return top_Ks
+        else:
+            return top_Ks, n_scores_calc, runtimes
+
+if __name__ == '__main__':
+
+    R = 10
+    n = 500000
+    K = 5
+
+    Y = np.random.randn(n, R)
+    queries = np.random.randn(10, R)
+
+    sharded_inferer = ShardedTopKInference(Y, n_shards=4)
+    inferer = TopKInference(Y, initialize_lists=True)
+
+    top_Ks, n_scored_sharded, runtimes_sharded = sharded_inferer.get_top_K(
+                queries, K, profile=True)
+    top_Ks_block, n_scored_block, runtimes_block = inferer.get_top_K(queries,
+                K, algorithm='block', profile=True)
+    sharded_inferer.close()
+
+    print 'Tested for data of size %s with R of %s' %(n, R)
+    print 'Block threshold: %s calculations in %s seconds' %(
+                np.mean(n_scored_block), np.mean(runtimes_block))
+    print 'Sharded threshold (%s shards): %s calculations in %s seconds' %(
+                sharded_inferer.n_shards, np.mean(n_scored_sharded),
+                np.mean(runtimes_sharded))
+    print 'Same scores:', np.allclose([[val for val, ind in top_list]
+                for top_list in top_Ks], [[val for val, ind in top_list]
+                for top_list in top_Ks_block])
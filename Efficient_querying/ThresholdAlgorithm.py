@@ -21,8 +21,7 @@ class ThresholdAlgorithmSparse:
         '''
         self.Y = Y
         self.Ni, self.K = Y.shape
-        self.steps_taken = [] #number of steps the algororithm takes for one query
-        self.calculated = [] #number of scores for one query
+        self.instrumentation = None #reports the steps and scores of a query
         if init:
             self.init_sorted_lists()
                 
@@ -54,6 +53,13 @@ class ThresholdAlgorithmSparse:
             N: number of top items to find
         '''
         return [self.bestN(x_u, N) for x_u in X]
+
+    def set_instrumentation(self, instrumentation):
+        '''
+        Reports the number of steps and of scores of every query to an
+        Instrumentation, None turns it off
+        '''
+        self.instrumentation = instrumentation
         
     def repairL(self, stepsBack, reversedks):
         '''
@@ -122,8 +128,11 @@ class ThresholdAlgorithmSparse:
                     n_items += 1
             steps += 1  
         #self.repairL(steps, reversed)#restore the lists for future use
-        self.steps_taken.append(steps)
-        self.calculated.append(n_items)
+        if self.instrumentation is not None:
+            trace = self.instrumentation.start('legacy_threshold_sparse')
+            if trace is not None:
+                trace.count_score(n=n_items)
+                self.instrumentation.finish(trace, steps, n_items)
         return S_values
         
 class ThresholdAlgorithm:
@@ -134,8 +143,7 @@ class ThresholdAlgorithm:
         self.Y = Y
         self.Ni = len(Y)
         self.K = len(Y[0])
-        self.steps_taken = [] #number of steps the algororithm takes for one query
-        self.calculated = [] #number of scores for one query
+        self.instrumentation = None #reports the steps and scores of a query
         if init:
             self.init_sorted_lists()
                 
@@ -157,6 +165,13 @@ class ThresholdAlgorithm:
             N: number of top items to find
         '''
         return [self.bestN(x_u, N) for x_u in X]
+
+    def set_instrumentation(self, instrumentation):
+        '''
+        Reports the number of steps and of scores of every query to an
+        Instrumentation, None turns it off
+        '''
+        self.instrumentation = instrumentation
         
     def repairL(self, stepsBack, reversedks):
         '''
@@ -211,8 +226,11 @@ class ThresholdAlgorithm:
                         
             steps += 1
         self.repairL(steps, reversed)#restore the lists for future use
-        self.steps_taken.append(steps)
-        self.calculated.append(n_items)
+        if self.instrumentation is not None:
+            trace = self.instrumentation.start('legacy_threshold')
+            if trace is not None:
+                trace.count_score(n=n_items)
+                self.instrumentation.finish(trace, steps, n_items)
         return S_values
 
 if __name__=="__main__":
@@ -222,6 +240,7 @@ if __name__=="__main__":
     import random as rd
     import numpy as np
     from sklearn.preprocessing import normalize
+    from instrumentation import Instrumentation, MemorySink
     
     rd.seed(99)
     
@@ -241,6 +260,8 @@ if __name__=="__main__":
 	    
 	    
 	    TA = ThresholdAlgorithm(Y)
+	    sink = MemorySink(nx)
+	    TA.set_instrumentation(Instrumentation(sink))
 	    
 	    
 	    TA.init_sorted_lists()
@@ -267,7 +288,7 @@ if __name__=="__main__":
 	    print 'Time to multiply in naive algorithm', Exact_Mult_Time - Fagin_Sort_Time
 	    print 'Time to run naive algorithm', Exact_Sort_Time - Exact_Mult_Time
 	    
-	    print 'Average number of steps in Fagin', np.mean(TA.steps_taken)
+	    print 'Average number of steps in Fagin', np.mean([record['depth'] for record in sink.records])
 	    
     if testSparse:
         density = 0.001
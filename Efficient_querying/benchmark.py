@@ -0,0 +1,399 @@
+"""
+Created on Sun Oct 18 2026
+Last update: -
+
+Reproducible benchmarks of the top-K engines: synthetic item matrices and
+queries, sweeps over M, R and K, and a machine-readable report that can be
+compared with a saved baseline
+
+Usage:
+    python benchmark.py --quick --output report.json
+    python benchmark.py --baseline report.json
+"""
+
+import numpy as np
+import json
+import sys
+from functools import partial
+from time import time
+from scipy import sparse
+from EfficientInference import TopKInference, TopKInferenceSparse
+from EfficientInferenceJIT import TopKInference as TopKInferenceJIT
+from BallTreeInference import BallTreeInference
+from QuantizedInference import QuantizedInference
+from FaginAlgorithm import FaginAlgorithm
+from instrumentation import Instrumentation, MemorySink
+from ThresholdAlgorithm import ThresholdAlgorithm
+
+# Workload generators
+# -------------------
+
+def gaussian_items(M, R, random_state):
+    return random_state.randn(M, R)
+
+def nonnegative_items(M, R, random_state):
+    return random_state.rand(M, R)
+
+def powerlaw_norm_items(M, R, random_state, a=2.0):
+    # random directions with heavy-tailed (Pareto) norms
+    Y = random_state.randn(M, R)
+    Y /= np.sqrt((Y**2).sum(1))[:, None]
+    return Y * (random_state.pareto(a, M) + 1)[:, None]
+
+def low_rank_items(M, R, random_state, noise=0.1):
+    # correlated latent features of rank R / 5
+    rank = max(1, R // 5)
+    Y = random_state.randn(M, rank).dot(random_state.randn(rank, R))
+    return Y + noise * random_state.randn(M, R)
+
+def sparse_items(M, R, random_state, density=0.01):
+    return sparse.rand(M, R, density=density, format='csr',
+                random_state=random_state)
+
+def gaussian_queries(n, R, random_state):
+    return random_state.randn(n, R)
+
+def nonnegative_queries(n, R, random_state):
+    return random_state.rand(n, R)
+
+def sparse_queries(n, R, random_state, density=0.05):
+    density = max(density, 3.0 / R)  # a few non-zeros for small R
+    return [sparse.rand(1, R, density=density, format='csr',
+                random_state=random_state) for i in range(n)]
+
+# name: (item generator, query generator, sparse data)
+WORKLOADS = {
+    'gaussian' : (gaussian_items, gaussian_queries, False),
+    'nonnegative' : (nonnegative_items, nonnegative_queries, False),
+    'powerlaw' : (powerlaw_norm_items, gaussian_queries, False),
+    'lowrank' : (low_rank_items, gaussian_queries, False),
+    'sparse_0.01' : (partial(sparse_items, density=0.01), sparse_queries,
+                True),
+    'sparse_0.001' : (partial(sparse_items, density=0.001), sparse_queries,
+                True),
+    }
+
+# Engines
+# -------
+# every engine is a pair of functions: build(Y) returns an index and
+# run(index, queries, K) returns the top lists and, per query, the latency,
+# the number of items scored and the depth reached (None if not reported)
+
+def _run_per_query(method, index, queries, K):
+    top_lists, latencies, n_scored, depths = [], [], [], []
+    for x_u in queries:
+        t0 = time()
+        top_list, n_items_scored, depth = method(index, x_u, K)
+        latencies.append(time() - t0)
+        top_lists.append(top_list)
+        n_scored.append(n_items_scored)
+        depths.append(depth)
+    return top_lists, latencies, n_scored, depths
+
+def _depth_recorder(index, max_records=1):
+    # lightest instrumentation: counts only, the depths are read from the sink
+    sink = MemorySink(max_records)
+    index.set_instrumentation(Instrumentation(sink, record_trajectory=False,
+                time_access=False))
+    return sink
+
+def _method(name):
+    # engine for a get_top_K_* method of TopKInference
+    def query(index, x_u, K):
+        if index.instrumentation is None:
+            _depth_recorder(index)
+        top_list, n_items_scored, runtime = getattr(index, name)(x_u, K, True)
+        return top_list, n_items_scored, \
+                    index.instrumentation.sink.records[-1]['depth']
+    return partial(_run_per_query, query)
+
+def _build_dense(Y):
+    return TopKInference(Y, initialize_lists=True)
+
+def _build_norm(Y):
+    return TopKInference(Y, initialize_lists=True, bucket_size=256)
+
+def _build_sparse(Y):
+    return TopKInferenceSparse(Y, initialize_lists=True)
+
+def _build_sparse_compressed(Y):
+    index = TopKInferenceSparse(Y, initialize_lists=True)
+    index.compress_postings(keep_sorted_lists=False)
+    return index
+
+def _build_ball(Y):
+    return BallTreeInference(Y)
+
+def _build_quantized(quantizer):
+    def build(Y):
+        return QuantizedInference(Y, quantizer=quantizer, seed=0)
+    return build
+
+def _build_jit(Y):
+    index = TopKInferenceJIT(Y)
+    for algorithm in ['naive', 'threshold', 'partial_threshold']:
+        index.get_top_K_compiled(Y[:1], 1, algorithm)  # compile
+    return index
+
+def _jit_method(algorithm):
+    def query(index, x_u, K):
+        values, indices, n_calc = index.get_top_K_compiled([x_u], K, algorithm)
+        return zip(values[0], indices[0]), n_calc[0] / index.R, None
+    return partial(_run_per_query, query)
+
+def _build_scan(dtype):
+    def build(Y):
+        index = TopKInferenceJIT(Y.astype(dtype), initialize_lists=False)
+        index.get_top_K_scan(Y[:1], 1)  # compile
+        return index
+    return build
+
+def _scan_query(index, x_u, K):
+    values, indices, n_calc = index.get_top_K_scan([x_u], K)
+    return zip(values[0], indices[0]), n_calc[0] / index.R, None
+
+def _run_batch(index, queries, K):
+    sink = _depth_recorder(index, len(queries))
+    top_lists, n_scored, runtimes = index.get_top_K_threshold_batch(queries, K,
+                count_calculations=True)
+    index.set_instrumentation(None)
+    # the traces arrive per sign pattern, not in the order of the queries,
+    # which is fine for the summary statistics
+    return top_lists, runtimes, n_scored, [record['depth']
+                for record in sink.records]
+
+def _build_legacy(cls):
+    def build(Y):
+        index = cls(Y.tolist())
+        index.init_sorted_lists(npsort=True)
+        _depth_recorder(index)
+        return index
+    return build
+
+def _legacy_query(index, x_u, K):
+    top_list = sorted(index.bestN(list(x_u), K))
+    record = index.instrumentation.sink.records[-1]
+    return top_list, record['items_scored'], record['depth']
+
+# name: (build, run, sparse data)
+ENGINES = {
+    'naive' : (_build_dense, _method('get_top_K_naive'), False),
+    'threshold' : (_build_dense, _method('get_top_K_threshold'), False),
+    'enhanced' : (_build_dense, _method('get_top_K_threshold_enhanced'),
+                False),
+    'partial' : (_build_dense, _method('get_top_K_partial_threshold'), False),
+    'block' : (_build_dense, _method('get_top_K_threshold_block'), False),
+    'batch' : (_build_dense, _run_batch, False),
+    'fagin' : (_build_dense, _method('get_top_K_fagin'), False),
+    'combined' : (_build_dense, _method('get_top_K_combined'), False),
+    'norm' : (_build_norm, _method('get_top_K_norm'), False),
+    'block_norm' : (_build_norm, _method('get_top_K_threshold_block'), False),
+    'ball' : (_build_ball, _method('get_top_K_ball'), False),
+    # approximate, 'exact' tells whether all top-K were found
+    'quantized_pq' : (_build_quantized('pq'), _method('get_top_K_quantized'),
+                False),
+    'quantized_int8' : (_build_quantized('int8'),
+                _method('get_top_K_quantized'), False),
+    'jit_naive' : (_build_jit, _jit_method('naive'), False),
+    'jit_threshold' : (_build_jit, _jit_method('threshold'), False),
+    'jit_partial' : (_build_jit, _jit_method('partial_threshold'), False),
+    'jit_scan' : (_build_scan(np.float64), partial(_run_per_query,
+                _scan_query), False),
+    # half the memory traffic, 'exact' may fail on float32 rounding
+    'jit_scan_float32' : (_build_scan(np.float32), partial(_run_per_query,
+                _scan_query), False),
+    'legacy_fagin' : (_build_legacy(FaginAlgorithm),
+                partial(_run_per_query, _legacy_query), False),
+    'legacy_threshold' : (_build_legacy(ThresholdAlgorithm),
+                partial(_run_per_query, _legacy_query), False),
+    'sparse_naive' : (_build_sparse, _method('get_top_K_naive'), True),
+    'sparse_threshold' : (_build_sparse, _method('get_top_K_threshold'),
+                True),
+    'sparse_enhanced' : (_build_sparse,
+                _method('get_top_K_threshold_enhanced'), True),
+    'sparse_wand' : (_build_sparse, _method('get_top_K_wand'), True),
+    'sparse_bmw' : (_build_sparse, _method('get_top_K_block_max_wand'), True),
+    'sparse_bmw_compressed' : (_build_sparse_compressed,
+                _method('get_top_K_block_max_wand'), True),
+    }
+
+DEFAULT_ENGINES = ['naive', 'threshold', 'enhanced', 'partial', 'block',
+            'batch', 'fagin', 'combined', 'norm', 'block_norm', 'ball',
+            'jit_naive', 'jit_threshold', 'jit_partial', 'jit_scan',
+            'sparse_naive', 'sparse_threshold', 'sparse_enhanced',
+            'sparse_wand', 'sparse_bmw', 'sparse_bmw_compressed']
+
+# Measurements
+# ------------
+
+def index_nbytes(index):
+    """
+    Memory used by the arrays of an index (numpy and scipy.sparse)
+    """
+    nbytes = 0
+    for value in vars(index).values():
+        if isinstance(value, np.ndarray):
+            nbytes += value.nbytes
+        elif sparse.issparse(value):
+            for name in ['data', 'indices', 'indptr', 'row', 'col']:
+                if hasattr(value, name):
+                    nbytes += getattr(value, name).nbytes
+    return nbytes
+
+def exact_scores(Y, queries, K):
+    """
+    K best scores (increasing) of every query, as ground truth
+    """
+    scores = []
+    for x_u in queries:
+        if sparse.issparse(x_u):
+            s = np.asarray(Y.dot(x_u.T).todense()).ravel()
+        else:
+            s = Y.dot(x_u)
+        scores.append(np.sort(s)[len(s)-K:])
+    return scores
+
+def _top_values(top_list, K, missing=-np.inf):
+    values = [item[0] if len(item) == 2 else missing for item in top_list]
+    return np.sort(values)[len(values)-K:]
+
+def benchmark_engine(engine, Y, queries, K):
+    """
+    Builds the index of an engine and runs the queries, returns a record
+    """
+    build, run, is_sparse = ENGINES[engine]
+    t0 = time()
+    index = build(Y)
+    build_time = time() - t0
+    run(index, queries[:1], K)  # warm up
+    top_lists, latencies, n_scored, depths = run(index, queries, K)
+    truth = exact_scores(Y, queries, K)
+    # the sparse engines only return items that have a positive score
+    missing = 0.0 if is_sparse else -np.inf
+    exact = all([np.allclose(_top_values(top_list, K, missing), true_values)
+                for top_list, true_values in zip(top_lists, truth)])
+    latencies = np.array(latencies)
+    depths = [depth for depth in depths if depth is not None]
+    return {'engine' : engine,
+            'build_time' : build_time,
+            'latency_mean' : latencies.mean(),
+            'latency_p50' : np.percentile(latencies, 50),
+            'latency_p90' : np.percentile(latencies, 90),
+            'latency_p99' : np.percentile(latencies, 99),
+            'items_scored_mean' : float(np.mean(n_scored)),
+            'items_scored_max' : float(np.max(n_scored)),
+            'depth_mean' : float(np.mean(depths)) if len(depths) else None,
+            'index_bytes' : index_nbytes(index),
+            'exact' : bool(exact)}
+
+def run_benchmark(engines=DEFAULT_ENGINES, workloads=WORKLOADS.keys(),
+            Ms=(10000, 100000), Rs=(10, 50), Ks=(1, 10), n_queries=50,
+            seed=0, verbose=True):
+    """
+    Runs every engine on every workload for all combinations of M, R and K,
+    returns a list of records
+    """
+    records = []
+    for workload in sorted(workloads):
+        item_generator, query_generator, is_sparse = WORKLOADS[workload]
+        for M in Ms:
+            for R in Rs:
+                random_state = np.random.RandomState(seed)
+                Y = item_generator(M, R, random_state)
+                queries = query_generator(n_queries, R, random_state)
+                for K in Ks:
+                    for engine in engines:
+                        if ENGINES[engine][2] != is_sparse:
+                            continue
+                        record = benchmark_engine(engine, Y, queries, K)
+                        record.update({'workload' : workload, 'M' : M,
+                                    'R' : R, 'K' : K})
+                        records.append(record)
+                        if verbose:
+                            print '%-12s M=%-7s R=%-4s K=%-3s %-16s p50 %.2e s, %s items scored%s' %(
+                                    workload, M, R, K, engine,
+                                    record['latency_p50'],
+                                    record['items_scored_mean'],
+                                    '' if record['exact'] else ' (NOT EXACT)')
+                            sys.stdout.flush()
+    return records
+
+# Reports
+# -------
+
+def _key(record):
+    return (record['workload'], record['M'], record['R'], record['K'],
+                record['engine'])
+
+def save_report(records, path):
+    report = {'created' : time(),
+              'numpy_version' : np.__version__,
+              'records' : records}
+    with open(path, 'w') as fh:
+        json.dump(report, fh, indent=2, sort_keys=True)
+
+def load_report(path):
+    with open(path) as fh:
+        return json.load(fh)['records']
+
+def compare_reports(records, baseline):
+    """
+    Ratios (current / baseline) of the latencies and the number of items
+    scored for the configurations present in both lists of records
+    """
+    baseline = dict([(_key(record), record) for record in baseline])
+    comparison = []
+    for record in records:
+        if _key(record) not in baseline:
+            continue
+        base = baseline[_key(record)]
+        ratios = {}
+        for measure in ['latency_p50', 'latency_p99', 'items_scored_mean']:
+            if base[measure]:
+                ratios[measure] = record[measure] / base[measure]
+            else:
+                ratios[measure] = None
+        ratios.update(dict(zip(['workload', 'M', 'R', 'K', 'engine'],
+                    _key(record))))
+        comparison.append(ratios)
+    return comparison
+
+def print_comparison(comparison):
+    print '%-12s %-7s %-4s %-3s %-16s %8s %8s %8s' %('workload', 'M', 'R',
+                'K', 'engine', 'p50', 'p99', 'scored')
+    for row in comparison:
+        print '%-12s %-7s %-4s %-3s %-16s %8.2f %8.2f %8.2f' %(row['workload'],
+                    row['M'], row['R'], row['K'], row['engine'],
+                    row['latency_p50'] or np.nan, row['latency_p99'] or np.nan,
+                    row['items_scored_mean'] or np.nan)
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the top-K engines')
+    parser.add_argument('--engines', nargs='+', default=DEFAULT_ENGINES,
+                choices=sorted(ENGINES.keys()))
+    parser.add_argument('--workloads', nargs='+', default=sorted(WORKLOADS),
+                choices=sorted(WORKLOADS))
+    parser.add_argument('--M', nargs='+', type=int, default=[10000, 100000])
+    parser.add_argument('--R', nargs='+', type=int, default=[10, 50])
+    parser.add_argument('--K', nargs='+', type=int, default=[1, 10])
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quick', action='store_true',
+                help='small sweep for a fast check')
+    parser.add_argument('--output', help='write the report to this file')
+    parser.add_argument('--baseline', help='compare with this report')
+    args = parser.parse_args()
+
+    if args.quick:
+        args.M, args.R, args.K, args.queries = [5000], [10], [5], 10
+
+    records = run_benchmark(args.engines, args.workloads, args.M, args.R,
+                args.K, args.queries, args.seed)
+    if args.output:
+        save_report(records, args.output)
+    if args.baseline:
+        print
+        print_comparison(compare_reports(records, load_report(args.baseline)))
@@ -64,6 +64,39 @@ def min_heapify(values, indices):
     for i in range(heaplength):
         min_heapify_from_i(values, indices, heaplength-i-1)
 
+# Compiled functions for fixed-size min heaps
+# -------------------------------------------
+
+@jit(nopython=True, nogil=True)
+def min_heap_replace(values, indices, val, ind):
+    # replaces the top of a min heap and sifts the new element down
+    heaplength = len(values)
+    i = 0
+    while True:
+        left = i*2 + 1
+        right = i*2 + 2
+        smallest = i
+        smallest_val = val
+        if left < heaplength and values[left] < smallest_val:
+            smallest = left
+            smallest_val = values[left]
+        if right < heaplength and values[right] < smallest_val:
+            smallest = right
+        if smallest == i:
+            break
+        values[i] = values[smallest]
+        indices[i] = indices[smallest]
+        i = smallest
+    values[i] = val
+    indices[i] = ind
+
+@jit(nopython=True, nogil=True)
+def min_heap_update(values, indices, val, ind):
+    # adds an element if it outperforms the top, returns the new top value
+    if val > values[0]:
+        min_heap_replace(values, indices, val, ind)
+    return values[0]
+
 # Some nice classes
 # -----------------
 
@@ -0,0 +1,116 @@
+"""
+Created on Sun Oct 18 2026
+Last update: -
+
+Per-query instrumentation of the top-K engines. An engine asks for a trace
+at the start of a query; when instrumentation is off or the query is not
+sampled it gets None and only pays for a few checks against None.
+Finished traces are sent as dictionaries to a sink, any callable.
+"""
+
+import random
+from collections import deque
+from time import time
+
+class QueryTrace():
+    """
+    Measurements of a single query
+    """
+    def __init__(self, engine, record_trajectory=True, time_access=True):
+        self.engine = engine
+        self.record_trajectory = record_trajectory
+        self.time_access = time_access
+        self.depth = 0
+        self.items_scored = 0
+        self.full_scores = 0
+        self.partial_scores = 0  # scorings stopped before all features
+        self.bound_trajectory = []  # (depth, upper bound, lower bound)
+        self.random_access_time = 0.0
+        self.start_time = time()
+        self.total_time = None
+
+    def step(self, depth, upper_bound, lower_bound):
+        """
+        Records the bounds after a step (depth or block) of sorted access
+        """
+        if self.record_trajectory:
+            self.bound_trajectory.append((depth, upper_bound, lower_bound))
+
+    def count_score(self, partial=False, n=1):
+        if partial:
+            self.partial_scores += n
+        else:
+            self.full_scores += n
+
+    def timed(self, score_function):
+        """
+        Wraps a function doing random access (scoring), to time it
+        """
+        if not self.time_access:
+            return score_function
+        def timed_score_function(*args):
+            t0 = time()
+            result = score_function(*args)
+            self.random_access_time += time() - t0
+            return result
+        return timed_score_function
+
+    def finish(self, depth, items_scored):
+        self.depth = depth
+        self.items_scored = items_scored
+        self.total_time = time() - self.start_time
+
+    def as_dict(self):
+        if self.time_access:
+            sorted_access_time = self.total_time - self.random_access_time
+        else:
+            sorted_access_time = None
+        return {'engine' : self.engine,
+                'depth' : self.depth,
+                'items_scored' : self.items_scored,
+                'full_scores' : self.full_scores,
+                'partial_scores' : self.partial_scores,
+                'bound_trajectory' : self.bound_trajectory,
+                'total_time' : self.total_time,
+                'random_access_time' : self.random_access_time,
+                'sorted_access_time' : sorted_access_time}
+
+class Instrumentation():
+    """
+    Hands out traces for a fraction sample_rate of the queries and sends the
+    finished traces to sink
+    Recording the bound trajectory and timing the random accesses can be
+    turned off to lower the cost of a trace
+    """
+    def __init__(self, sink, sample_rate=1.0, record_trajectory=True,
+                time_access=True, seed=None):
+        self.sink = sink
+        self.sample_rate = sample_rate
+        self.record_trajectory = record_trajectory
+        self.time_access = time_access
+        self._random = random.Random(seed)
+
+    def start(self, engine):
+        """
+        Returns a new trace, or None when this query is not sampled
+        """
+        if self.sample_rate < 1.0 and self._random.random() >= self.sample_rate:
+            return None
+        return QueryTrace(engine, self.record_trajectory, self.time_access)
+
+    def finish(self, trace, depth, items_scored):
+        trace.finish(depth, items_scored)
+        self.sink(trace.as_dict())
+
+class MemorySink():
+    """
+    Sink that keeps the last max_records traces
+    """
+    def __init__(self, max_records=10000):
+        self.records = deque(maxlen=max_records)
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def clear(self):
+        self.records.clear()
@@ -0,0 +1,116 @@
+"""
+Created on Sun Oct 18 2026
+Last update: -
+
+Compressed storage of the postings of the sparse index, in blocks of
+postings in increasing order of the rows. The rows of a block are stored as
+the first row and the bit-packed differences between successive rows, with
+the smallest width that fits all differences of the block. The values are
+quantized to a byte relative to the maximum of their block, rounded up so
+that the decoded values are upper bounds of the real ones.
+"""
+
+import numpy as np
+from numba import jit
+
+IMPACT_LEVELS = 255
+
+@jit(nopython=True, nogil=True)
+def pack_rows(rows, block_starts, block_bits, block_offsets, packed):
+    """
+    Writes the differences between the successive rows of every block,
+    with block_bits[b] bits each, at byte block_offsets[b] of packed
+    """
+    for b in range(len(block_starts) - 1):
+        bit = block_offsets[b] * 8
+        for p in range(block_starts[b] + 1, block_starts[b + 1]):
+            delta = np.int64(rows[p] - rows[p - 1])
+            for k in range(block_bits[b]):
+                if (delta >> k) & 1:
+                    packed[bit >> 3] |= np.uint8(1 << (bit & 7))
+                bit += 1
+
+@jit(nopython=True, nogil=True)
+def unpack_rows(packed, offset, bits, first, n, out):
+    """
+    Decodes the n rows of a block into out
+    """
+    out[0] = first
+    mask = (np.int64(1) << bits) - 1
+    bit = np.int64(offset) * 8
+    for i in range(1, n):
+        byte = bit >> 3
+        shift = bit & 7
+        word = np.int64(0)
+        for k in range((shift + bits + 7) >> 3):
+            word |= np.int64(packed[byte + k]) << (8 * k)
+        out[i] = out[i - 1] + ((word >> shift) & mask)
+        bit += bits
+
+def block_widths(rows, block_starts):
+    """
+    Number of bits needed for the largest difference between successive
+    rows of every block
+    """
+    deltas = np.diff(rows.astype(np.int64))
+    deltas[block_starts[1:-1] - 1] = 0  # across block boundaries
+    widths = np.zeros(len(block_starts) - 1, dtype=np.uint8)
+    long_blocks = np.diff(block_starts) > 1
+    if long_blocks.any():
+        # the differences of block b start at block_starts[b]
+        largest = np.maximum.reduceat(deltas, block_starts[:-1][long_blocks])
+        widths[long_blocks] = np.floor(np.log2(np.maximum(largest, 1))) + 1
+    return widths
+
+def compress_rows(rows, block_starts):
+    """
+    Returns the first row, the bit width and the byte offset of every block
+    and the packed differences
+    """
+    block_bits = block_widths(rows, block_starts)
+    n_bytes = (np.maximum(np.diff(block_starts) - 1, 0) *
+                block_bits.astype(np.int64) + 7) // 8
+    block_offsets = np.concatenate(([0], np.cumsum(n_bytes)))
+    packed = np.zeros(block_offsets[-1], dtype=np.uint8)
+    pack_rows(rows, block_starts, block_bits, block_offsets, packed)
+    if block_offsets[-1] <= np.iinfo(np.uint32).max:
+        block_offsets = block_offsets.astype(np.uint32)
+    return rows[block_starts[:-1]], block_bits, block_offsets[:-1], packed
+
+def quantize_impacts(values, block_starts, block_max):
+    """
+    Quantizes the values to a byte q of their block, such that
+    q * block_max / IMPACT_LEVELS is at least the value
+    """
+    scale = np.repeat(block_max, np.diff(block_starts))
+    scale[scale <= 0] = 1.0
+    impacts = np.clip(np.ceil(values * IMPACT_LEVELS / scale), 0,
+                IMPACT_LEVELS)
+    # correct the rounding of the division
+    impacts += (impacts * scale / IMPACT_LEVELS < values) & \
+                (impacts < IMPACT_LEVELS)
+    return impacts.astype(np.uint8)
+
+if __name__ == '__main__':
+
+    from scipy import sparse
+    from EfficientInference import TopKInferenceSparse
+
+    R = 1000
+    n = 100000
+    K = 5
+
+    Y = sparse.rand(n, R, density=0.005, format='csr')
+    x_u = sparse.rand(1, R, density=0.01)
+
+    inferer = TopKInferenceSparse(Y, initialize_lists=True)
+    n_bytes = inferer.doc_rows.nbytes + inferer.doc_values.nbytes
+    top_list = inferer.get_top_K_block_max_wand(x_u, K)
+    inferer.compress_postings()
+    n_bytes_compressed = inferer.packed_rows.nbytes + inferer.impacts.nbytes + \
+                inferer.block_first.nbytes + inferer.block_bits.nbytes + \
+                inferer.block_offsets.nbytes
+
+    print 'Postings of %s non-zeros: %s bytes, %s bytes compressed' %(Y.nnz,
+                n_bytes, n_bytes_compressed)
+    print 'Same top-K:', top_list == inferer.get_top_K_block_max_wand(x_u, K)
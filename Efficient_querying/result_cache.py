@@ -0,0 +1,90 @@
+"""
+Created on Sun Oct 18 2026
+Last update: -
+
+LRU cache for the results of top-K queries, with size and time-based
+eviction. A result for K' also answers the same query for any K <= K',
+unless the algorithm does not order its results by their exact scores
+"""
+
+import numpy as np
+import hashlib
+from collections import OrderedDict
+from time import time
+
+def query_key(x_u, algorithm):
+    """
+    Key of a query: hash of the query vector and the algorithm
+    """
+    if hasattr(x_u, 'toarray'):
+        x_u = x_u.toarray()  # sparse queries
+    x_u = np.ascontiguousarray(x_u, dtype=float)
+    return (hashlib.sha1(x_u.data).hexdigest(), algorithm)
+
+class ResultCache():
+    """
+    Cache of top lists with at most max_size entries, which expire after
+    ttl seconds (never if ttl is None)
+    The cache is cleared when the version of the index changes
+    """
+    def __init__(self, max_size=10000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.version = None
+        self._entries = OrderedDict()  # key: (K, top list, time stored)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def clear(self):
+        self._entries.clear()
+
+    def check_version(self, version):
+        """
+        Invalidates all entries if the index has changed
+        """
+        if version != self.version:
+            self.clear()
+            self.version = version
+
+    def get(self, x_u, K, algorithm, exact_K=False):
+        """
+        Returns the cached top list for the query, None if not present
+        With exact_K, only a result for the same K is returned
+        """
+        key = query_key(x_u, algorithm)
+        entry = self._entries.pop(key, None)
+        if entry is not None and self.ttl is not None and \
+                time() - entry[2] > self.ttl:
+            entry = None
+            self.evictions += 1
+        if entry is None or entry[0] < K or (exact_K and entry[0] != K):
+            if entry is not None:
+                self._entries[key] = entry
+            self.misses += 1
+            return None
+        self._entries[key] = entry  # most recently used at the end
+        self.hits += 1
+        return entry[1][len(entry[1])-K:]
+
+    def put(self, x_u, K, algorithm, top_list, exact_K=False):
+        """
+        Stores the top list of a query, unless a larger K is already cached
+        (with exact_K the last K replaces the cached one)
+        """
+        key = query_key(x_u, algorithm)
+        entry = self._entries.pop(key, None)
+        if entry is not None and entry[0] > K and not exact_K:
+            self._entries[key] = entry
+            return
+        self._entries[key] = (K, top_list, time())
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)  # least recently used
+            self.evictions += 1
+
+    def stats(self):
+        """
+        Returns the counters of the cache
+        """
+        return {'size' : len(self._entries), 'hits' : self.hits,
+                'misses' : self.misses, 'evictions' : self.evictions}
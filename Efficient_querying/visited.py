@@ -0,0 +1,48 @@
+"""
+Created on Sun Oct 18 2026
+Last update: -
+
+Reusable visited marks for the walks over the sorted lists. Every item has
+a uint32 stamp and an item is visited in the current query when its stamp
+equals the current epoch, so that a new query only increments the epoch
+instead of clearing an array (or building a set) of the size of the index.
+"""
+
+import numpy as np
+
+MAX_EPOCH = np.iinfo(np.uint32).max
+
+class VisitedStamps():
+    """
+    Epoch stamps for n items, a query asks for a new epoch before its walk
+    Not thread-safe, every worker keeps its own stamps
+    """
+    def __init__(self, n):
+        self.stamps = np.zeros(n, dtype=np.uint32)
+        self.epoch = 0
+
+    def resize(self, n):
+        """
+        Makes room for n items, new items are not visited
+        The capacity at least doubles, so that a growing index does not copy
+        the stamps for every new item
+        """
+        if n > len(self.stamps):
+            self.stamps = np.concatenate((self.stamps, np.zeros(
+                        max(n, 2 * len(self.stamps)) - len(self.stamps),
+                        dtype=np.uint32)))
+
+    def new_epochs(self, n_epochs=1):
+        """
+        Returns the first of n_epochs new epochs, the stamps are only
+        cleared when the counter would overflow
+        """
+        if self.epoch + n_epochs > MAX_EPOCH:
+            self.stamps[:] = 0
+            self.epoch = 0
+        first = self.epoch + 1
+        self.epoch += n_epochs
+        return first
+
+    def new_epoch(self):
+        return self.new_epochs(1)